@@ -0,0 +1,80 @@
+import time
+import argparse
+import torch
+from datasets import Image as ImageFeature, load_dataset
+from transformers import CLIPImageProcessor
+
+from encode import FastImageCollator, ImageCollator, IMAGE_FIELD
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Benchmark image preprocessing')
+    parser.add_argument('--inputs', type=str, default='TREC-AToMiC/AToMiC-Images-v0.2')
+    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
+    parser.add_argument('--id_column', type=str, default='image_id')
+    parser.add_argument('--num_images', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads, 1 matches one DataLoader worker')
+    return parser
+
+
+class DecodingCollator:
+    """decode like `datasets` does before handing items to `ImageCollator`"""
+    def __init__(self, collator):
+        self.collator = collator
+        self.feature = ImageFeature()
+
+    def __call__(self, batch):
+        batch = [dict(item, **{IMAGE_FIELD: self.feature.decode_example(item[IMAGE_FIELD])}) for item in batch]
+        return self.collator(batch)
+
+
+def run(collator, items, batch_size, repeats):
+    """return images/sec of the best repeat and the preprocessed pixels"""
+    best = float('inf')
+    for _ in range(repeats):
+        outputs = []
+        start = time.perf_counter()
+        for i in range(0, len(items), batch_size):
+            outputs.append(collator(items[i:i + batch_size])['image']['pixel_values'])
+        best = min(best, time.perf_counter() - start)
+    return len(items) / best, torch.cat(outputs)
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    processor = CLIPImageProcessor.from_pretrained(args.encoder)
+
+    dataset = load_dataset(args.inputs, split='train')
+    dataset = dataset.select(range(min(args.num_images, len(dataset))))
+    dataset = dataset.select_columns([args.id_column, IMAGE_FIELD])
+    dataset = dataset.cast_column(IMAGE_FIELD, ImageFeature(decode=False))
+    items = list(dataset)
+
+    collators = {
+        'torch': DecodingCollator(ImageCollator(args.id_column, IMAGE_FIELD, processor)),
+        'pil': FastImageCollator(args.id_column, IMAGE_FIELD, processor),
+    }
+    results = {}
+    for name, collator in collators.items():
+        results[name] = run(collator, items, args.batch_size, args.repeats)
+        logging.info('%s: %.1f images/sec per worker', name, results[name][0])
+
+    diff = (results['pil'][1] - results['torch'][1]).abs()
+    logging.info('speedup: %.2fx', results['pil'][0] / results['torch'][0])
+    logging.info('pixel difference after normalization: mean %.4f, max %.4f', diff.mean(), diff.max())
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,98 @@
+import time
+import itertools
+import base64
+import asyncio
+import argparse
+import numpy as np
+import aiohttp
+from datasets import Image as ImageFeature
+from datasets import load_dataset
+
+from encode import TextCollator, IMAGE_FIELD, TEXT_FIELDS
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Load test serve.py')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080')
+    parser.add_argument('--inputs', type=str, default='TREC-AToMiC/AToMiC-Texts-v0.2.1', help='collection the queries are taken from')
+    parser.add_argument('--encode_type', type=str, default='text', choices=['text', 'image'])
+    parser.add_argument('--num_samples', type=int, default=512, help='distinct queries, sent round robin')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32, help='clients, each sends its next request when the last one returns')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--hits', type=int, default=10)
+    return parser
+
+
+def load_queries(args):
+    dataset = load_dataset(args.inputs, split='train')
+    dataset = dataset.select(range(min(args.num_samples, len(dataset))))
+    if args.encode_type == 'text':
+        collator = TextCollator(None, TEXT_FIELDS, processor=None)
+        return [{'text': collator.get_text(item), 'k': args.hits} for item in dataset]
+    dataset = dataset.cast_column(IMAGE_FIELD, ImageFeature(decode=False))
+    queries = []
+    for image in dataset[IMAGE_FIELD]:
+        if image['bytes'] is None:
+            with open(image['path'], 'rb') as f:
+                image['bytes'] = f.read()
+        queries.append({'image': base64.b64encode(image['bytes']).decode('ascii'), 'k': args.hits})
+    return queries
+
+
+async def client(session, url, queries, counter, total, latencies):
+    while True:
+        request_id = next(counter)
+        if request_id >= total:
+            return
+        start = time.perf_counter()
+        async with session.post(url, json=queries[request_id % len(queries)]) as response:
+            response.raise_for_status()
+            await response.read()
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(args, queries, total):
+    """send `total` requests from `--concurrency` clients, return the latencies, the wall time and the server stats"""
+    counter, latencies = itertools.count(), []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            client(session, f'{args.url}/search', queries, counter, total, latencies)
+            for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+        async with session.get(f'{args.url}/stats') as response:
+            stats = await response.json()
+    return np.array(latencies), elapsed, stats
+
+
+def main(args):
+    queries = load_queries(args)
+    loop = asyncio.get_event_loop()
+    if args.warmup:
+        loop.run_until_complete(run(args, queries, args.warmup))
+    latencies, elapsed, stats = loop.run_until_complete(run(args, queries, args.requests))
+
+    logging.info('%d requests from %d clients in %.2fs: %.1f QPS', len(latencies), args.concurrency, elapsed, len(latencies) / elapsed)
+    logging.info(
+        'latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f',
+        *(1000 * np.percentile(latencies, [50, 90, 99, 100])),
+    )
+    # server side, warmup included
+    logging.info('mean batch size: %.1f', stats[args.encode_type]['mean_batch_size'])
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,76 @@
+import time
+import argparse
+import numpy as np
+import torch
+from datasets import load_dataset
+
+from encoders import BACKENDS, ClipEncoder, cosine_drift
+from encode import ImageCollator, TextCollator, IMAGE_FIELD, TEXT_FIELDS
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Compare an inference backend against fp32 eager')
+    parser.add_argument('--inputs', type=str, default='TREC-AToMiC/AToMiC-Texts-v0.2.1')
+    parser.add_argument('--encode_type', type=str, default='text', choices=['text', 'image'])
+    parser.add_argument('--id_column', type=str, default='text_id')
+    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
+    parser.add_argument('--backend', type=str, default='int8', choices=BACKENDS)
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--onnx_dir', type=str, default='onnx')
+    parser.add_argument('--num_samples', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=None)
+    return parser
+
+
+def encode_all(encoder, batches):
+    """return the embeddings and the rows/sec of the timed pass"""
+    # the first batch warms up compiled and exported graphs
+    encoder.encode(batches[0])
+    start = time.perf_counter()
+    embeddings = np.concatenate([encoder.encode(batch) for batch in batches])
+    return embeddings, len(embeddings) / (time.perf_counter() - start)
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    dataset = load_dataset(args.inputs, split='train')
+    dataset = dataset.select(range(min(args.num_samples, len(dataset))))
+
+    reference = ClipEncoder(args.encoder, encode_type=args.encode_type, dtype='fp32', backend='eager')
+    candidate = ClipEncoder(
+        args.encoder, encode_type=args.encode_type, dtype=args.dtype,
+        backend=args.backend, onnx_dir=args.onnx_dir,
+    )
+
+    if args.encode_type == 'text':
+        collator = TextCollator(args.id_column, TEXT_FIELDS, reference.processor.tokenizer)
+    else:
+        collator = ImageCollator(args.id_column, IMAGE_FIELD, reference.processor.image_processor)
+    items = list(dataset)
+    # each encoder moves the inputs it is given, so give each its own copy
+    make_batches = lambda: [collator(items[i:i + args.batch_size]) for i in range(0, len(items), args.batch_size)]
+
+    reference_embeddings, reference_speed = encode_all(reference, make_batches())
+    candidate_embeddings, candidate_speed = encode_all(candidate, make_batches())
+
+    logging.info('fp32 eager: %.1f rows/sec', reference_speed)
+    logging.info('%s %s: %.1f rows/sec (%.2fx)', args.dtype, args.backend, candidate_speed, candidate_speed / reference_speed)
+    for name, value in cosine_drift(reference_embeddings, candidate_embeddings).items():
+        logging.info('%s: %.6f', name, value)
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,119 @@
+import hashlib
+import sqlite3
+import numpy as np
+import torch
+from pathlib import Path
+
+import logging
+
+# sqlite allows at most 999 parameters per statement on older builds
+MAX_PARAMS = 900
+
+
+def content_hash(content):
+    """hash of a normalized text or of raw image bytes"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def image_hash(image):
+    """hash of the file bytes of an undecoded `datasets.Image` value, or of the pixels of a PIL image"""
+    if isinstance(image, dict):
+        if image['bytes'] is not None:
+            return content_hash(image['bytes'])
+        with open(image['path'], 'rb') as f:
+            return content_hash(f.read())
+    return content_hash(f'{image.mode}:{image.size}:'.encode() + image.tobytes())
+
+
+class EmbeddingCache:
+    """Persistent content-addressed store of embeddings.
+
+    Vectors are kept in a sqlite file, keyed by a namespace (the model and
+    everything else that changes its outputs) and the content hash of the
+    input. Several shard processes can share one file.
+    """
+    def __init__(self, path, namespace, dtype=np.float16):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.namespace = namespace
+        self.dtype = np.dtype(dtype)
+        self.conn = sqlite3.connect(str(path), timeout=600)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'namespace TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, '
+            'PRIMARY KEY (namespace, hash)) WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+    def get_many(self, hashes):
+        """return {hash: vector} for the hashes that are cached"""
+        hashes = list(set(hashes))
+        found = {}
+        for start in range(0, len(hashes), MAX_PARAMS):
+            chunk = hashes[start:start + MAX_PARAMS]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE namespace = ? AND hash IN ({','.join('?' * len(chunk))})",
+                [self.namespace] + chunk,
+            )
+            for _hash, vector in rows:
+                found[_hash] = np.frombuffer(vector, dtype=self.dtype)
+        return found
+
+    def put_many(self, vectors):
+        """store {hash: vector}"""
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO embeddings (namespace, hash, vector) VALUES (?, ?, ?)',
+            [(self.namespace, _hash, np.asarray(vector, dtype=self.dtype).tobytes()) for _hash, vector in vectors.items()],
+        )
+        self.conn.commit()
+
+    def __len__(self):
+        count, = self.conn.execute('SELECT COUNT(*) FROM embeddings WHERE namespace = ?', [self.namespace]).fetchone()
+        return count
+
+    def close(self):
+        self.conn.close()
+
+
+class CachedEncoder:
+    """Wrap an encoder so that only content missing from `cache` reaches the model.
+
+    Batches need a `hash` list next to the model inputs. Rows whose hash is
+    cached, or repeats an earlier row of the batch, are not encoded.
+    """
+    def __init__(self, encoder, cache):
+        self.encoder = encoder
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, batch):
+        hashes = batch['hash']
+        vectors = self.cache.get_many(hashes)
+
+        # first row of every hash that still has to be encoded
+        missing = {}
+        for row, _hash in enumerate(hashes):
+            if _hash not in vectors and _hash not in missing:
+                missing[_hash] = row
+        self.misses += len(missing)
+        self.hits += len(hashes) - len(missing)
+
+        if missing:
+            encode_type = self.encoder.encode_type
+            rows = torch.as_tensor(list(missing.values()))
+            inputs = {k: v[rows] for k, v in batch[encode_type].items()}
+            encoded = dict(zip(missing, self.encoder.encode({encode_type: inputs})))
+            self.cache.put_many(encoded)
+            vectors.update(encoded)
+        return np.stack([vectors[_hash] for _hash in hashes])
+
+    def report(self):
+        total = self.hits + self.misses
+        logging.info(
+            'Embedding cache: %d of %d rows reused (%.1f%%), %d encoded',
+            self.hits, total, 100 * self.hits / max(total, 1), self.misses,
+        )
@@ -1,6 +1,11 @@
 import os
 import sys
 import math
+import json
+import time
+import queue
+import struct
+import threading
 import numpy as np
 import argparse
 
@@ -8,11 +13,17 @@ import torch
 import torch.nn as nn
 from torchvision.transforms import CenterCrop, ConvertImageDtype, Normalize, Resize, ToTensor
 from torchvision.transforms.functional import InterpolationMode
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler, get_worker_info
+from datasets import Image as ImageFeature
+from datasets.distributed import split_dataset_by_node
+from PIL import Image
 
 from io import BytesIO
 from pathlib import Path
-from encoders import ClipEncoder
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from encoders import BACKENDS, ClipEncoder
+from embedding_cache import CachedEncoder, EmbeddingCache, content_hash, image_hash
 from tqdm.auto import tqdm
 
 import logging
@@ -26,7 +37,10 @@ module_path = str(Path(__file__).absolute().parents[2])
 sys.path.append(module_path)
 os.environ['NUMEXPR_MAX_THREADS'] = '8'
 
-from src.data import AtomicDataset
+from src.data import SPLITS, AtomicDataset, load_streaming_dataset
+
+TEXT_FIELDS = ['page_title', 'section_title', 'hierachy', 'context_section_description', 'context_page_description']
+IMAGE_FIELD = 'image'
 
 
 def get_args_parser():
@@ -34,67 +48,134 @@ def get_args_parser():
     parser.add_argument('--inputs', type=str, default='TREC-AToMiC/AToMiC-Texts-v0.2.1')
     parser.add_argument('--encode_type', type=str, default='text', choices=['text', 'image'])
     parser.add_argument('--id_column', type=str, default='text_id')
-    parser.add_argument('--split', type=str, default='validation')
+    parser.add_argument('--split', type=str, default='validation', help="a split, a comma separated list of splits, or 'all' to encode them in one pass")
     parser.add_argument('--qrels', type=str, default='TREC-AToMiC/AToMiC-Qrels-v0.2')
+    parser.add_argument('--streaming', action='store_true', help='stream local parquet shards given by --inputs instead of loading the dataset')
     parser.add_argument('--shard_id', type=int, default=0)
     parser.add_argument('--shard_num', type=int, default=1)
     parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads, default: torch decides')
     parser.add_argument('--device', type=str, default='cpu')
     parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--backend', type=str, default='eager', choices=BACKENDS, help='inference backend, see check_backend.py for parity')
+    parser.add_argument('--onnx_dir', type=str, default='onnx', help='where --backend onnx exports the model')
+    parser.add_argument('--pipeline', action='store_true', help='overlap data loading, inference and writing in separate threads')
+    parser.add_argument('--prefetch', type=int, default=4, help='batches queued between pipeline stages')
     parser.add_argument('--output_dir', type=str, help='directory to store embeddings')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of this shard')
+    parser.add_argument('--checkpoint_interval', type=float, default=60, help='seconds between checkpoints')
+    parser.add_argument('--progress_interval', type=float, default=None, help='seconds between progress.<shard>.json updates, set by encode_parallel.py')
+    parser.add_argument('--pretokenize', action='store_true', help='tokenize texts once with dataset.map and cache the token ids')
+    parser.add_argument('--num_proc', type=int, default=None, help='processes for --pretokenize')
+    parser.add_argument('--bucket_by_length', action='store_true', help='batch texts of similar length and pad per batch, implies --pretokenize')
+    parser.add_argument('--bucket_size', type=int, default=100, help='batches per length-sorted bucket')
+    parser.add_argument('--image_preprocess', type=str, default='torch', choices=['torch', 'pil'], help='pil: reduced-resolution decode and uint8 resize, see bench_image_collator.py')
+    parser.add_argument('--embedding_cache', type=str, default=None, help='sqlite file of embeddings keyed by content hash, reused across runs')
 
     return parser
 
 
 class TextCollator:
-    def __init__(self, id_col, field_col, processor, prompt=None):
+    def __init__(self, id_col, field_col, processor, prompt=None, max_length=77, hash_content=False):
         self.id_col = id_col
         self.field_col = field_col
         self.processor = processor
         self.prompt = prompt
+        self.max_length = max_length
+        self.hash_content = hash_content
     
-    def __call__(self, batch):
-        batch_ids, batch_inputs = [], []
-        for item in batch:
-            batch_ids.append(item[self.id_col])
-            content = []
-            if isinstance(self.field_col, list):
-                for field in self.field_col:
-                    # if the column val is a list, concat again
-                    if isinstance(item[field], list):
-                        content.append(' '.join(item[field]))
-                    else:
-                        content.append(item[field])
-            else:
-                content.append(item[self.field_col])
-            
-            text = ' '.join(content)
-            batch_inputs.append(text)
+    def get_text(self, item):
+        content = []
+        if isinstance(self.field_col, list):
+            for field in self.field_col:
+                # if the column val is a list, concat again
+                if isinstance(item[field], list):
+                    content.append(' '.join(item[field]))
+                else:
+                    content.append(item[field])
+        else:
+            content.append(item[self.field_col])
         
+        text = ' '.join(content)
         if self.prompt:
-            _inputs = []
-            for item in batch_inputs:
-                _inputs.append(f'{self.prompt}{item}')
-            batch_inputs = _inputs
-        else:
-            batch_inputs = batch_inputs
-
-        batch_inputs = self.processor(
-            text=batch_inputs,
+            text = f'{self.prompt}{text}'
+        return text
+    
+    def tokenize(self, batch):
+        """`dataset.map(batched=True)` function that caches unpadded token ids"""
+        items = [dict(zip(batch, values)) for values in zip(*batch.values())]
+        texts = [self.get_text(item) for item in items]
+        input_ids = self.processor(
+            text=texts,
             add_special_tokens=True,
-            return_tensors='pt',
-            padding='max_length',
-            max_length=77,
+            max_length=self.max_length,
             truncation=True,
-            return_token_type_ids=False,
-        )
+        )['input_ids']
+        outputs = {
+            'input_ids': input_ids,
+            'length': [len(ids) for ids in input_ids],
+        }
+        if self.hash_content:
+            outputs['hash'] = [content_hash(text) for text in texts]
+        return outputs
+    
+    def __call__(self, batch):
+        batch_ids = [item[self.id_col] for item in batch]
+        
+        if 'input_ids' in batch[0]:
+            # pre-tokenized, only pad to the longest text of the batch
+            batch_inputs = self.processor.pad(
+                {'input_ids': [item['input_ids'] for item in batch]},
+                padding='longest',
+                return_tensors='pt',
+            )
+        else:
+            batch_inputs = self.processor(
+                text=[self.get_text(item) for item in batch],
+                add_special_tokens=True,
+                return_tensors='pt',
+                padding='max_length',
+                max_length=self.max_length,
+                truncation=True,
+                return_token_type_ids=False,
+            )
 
-        return {
+        outputs = {
             'id': batch_ids,
             'text': batch_inputs,
         }
+        if 'position' in batch[0]:
+            outputs['position'] = [item['position'] for item in batch]
+        if self.hash_content:
+            outputs['hash'] = [item['hash'] if 'hash' in item else content_hash(self.get_text(item)) for item in batch]
+        return outputs
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Yield batches of similar length.
+
+    Rows are sorted by length within consecutive buckets of
+    `batch_size * bucket_size` rows, so rows never move out of their bucket
+    and a `ReorderBuffer` restores row order holding at most one bucket.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_rows = batch_size * bucket_size
+    
+    def __iter__(self):
+        for start in range(0, len(self.lengths), self.bucket_rows):
+            lengths = self.lengths[start:start + self.bucket_rows]
+            order = start + np.argsort(-lengths, kind='stable')
+            for i in range(0, len(order), self.batch_size):
+                yield order[i:i + self.batch_size].tolist()
+    
+    def __len__(self):
+        full, rest = divmod(len(self.lengths), self.bucket_rows)
+        return full * math.ceil(self.bucket_rows / self.batch_size) + math.ceil(rest / self.batch_size)
+
 
 class Transform(nn.Module):
     def __init__(self, image_size, mean, std):
@@ -114,9 +195,11 @@ class Transform(nn.Module):
 
 
 class ImageCollator:
-    def __init__(self, id_col, field_col, processor):
+    def __init__(self, id_col, field_col, processor, hash_content=False):
         self.id_col = id_col
         self.field_col = field_col
+        self.hash_content = hash_content
+        self.feature = ImageFeature()
 
         transforms = Transform(
             [processor.crop_size['height'], processor.crop_size['width']],
@@ -126,63 +209,531 @@ class ImageCollator:
         self.transforms = torch.jit.script(transforms)
     
     def __call__(self, batch):
-        batch_ids, batch_inputs = [], []
+        batch_ids, batch_inputs, batch_hashes = [], [], []
         
         for item in batch:
             batch_ids.append(item[self.id_col])
-            batch_inputs.append(self.transforms(ToTensor()(item[self.field_col])))
+            image = item[self.field_col]
+            if self.hash_content:
+                batch_hashes.append(image_hash(image))
+            if isinstance(image, dict):
+                # not decoded by the dataset, decode it the same way
+                image = self.feature.decode_example(image)
+            batch_inputs.append(self.transforms(ToTensor()(image)))
         
-        return {
+        outputs = {
             'id': batch_ids,
             'image': {'pixel_values': torch.stack(batch_inputs)},
         }
+        if self.hash_content:
+            outputs['hash'] = batch_hashes
+        return outputs
+
+
+class FastImageCollator:
+    """Same output as `ImageCollator`, with the heavy work done on uint8.
+
+    Images are decoded from their bytes in the collator, JPEGs at reduced
+    resolution through `draft`. They are shrunk by an integer factor with
+    `reducing_gap`, then resized with bicubic interpolation, all in PIL on
+    uint8. Only the stacked batch is converted to float and normalized.
+    Works best when the image column is not decoded by the dataset
+    (`datasets.Image(decode=False)`).
+    """
+    def __init__(self, id_col, field_col, processor, reducing_gap=3.0, hash_content=False):
+        self.id_col = id_col
+        self.field_col = field_col
+        self.hash_content = hash_content
+        self.size = (processor.crop_size['width'], processor.crop_size['height'])
+        self.reducing_gap = reducing_gap
+
+        # (x / 255 - mean) / std as a single multiply-add
+        mean = torch.tensor(processor.image_mean).view(1, 3, 1, 1)
+        std = torch.tensor(processor.image_std).view(1, 3, 1, 1)
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = -mean / std
+    
+    def load(self, image):
+        if isinstance(image, dict):
+            image = Image.open(BytesIO(image['bytes']) if image['bytes'] else image['path'])
+        # only JPEG supports draft, other formats ignore it
+        image.draft('RGB', self.size)
+        image = image.convert('RGB')
+        image = image.resize(self.size, Image.BICUBIC, reducing_gap=self.reducing_gap)
+        return torch.from_numpy(np.asarray(image))
+    
+    def __call__(self, batch):
+        batch_ids, batch_inputs, batch_hashes = [], [], []
+        
+        for item in batch:
+            batch_ids.append(item[self.id_col])
+            if self.hash_content:
+                batch_hashes.append(image_hash(item[self.field_col]))
+            batch_inputs.append(self.load(item[self.field_col]))
+        
+        pixel_values = torch.stack(batch_inputs).permute(0, 3, 1, 2).float()
+        pixel_values = pixel_values.mul_(self.scale).add_(self.shift)
+        outputs = {
+            'id': batch_ids,
+            'image': {'pixel_values': pixel_values.contiguous()},
+        }
+        if self.hash_content:
+            outputs['hash'] = batch_hashes
+        return outputs
+
+
+# fixed .npy header size, so the header can be rewritten once the row count is known
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(dtype, shape):
+    header = repr({
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': tuple(shape),
+    }).encode('latin1')
+    # magic string (6) + version (2) + header length (2)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + b'\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header
 
 
 class NumpyWriter:
-    def __init__(self, dir_path, filename, shard_id, shard_num):
+    """Write embeddings to `.npy` shards batch by batch.
+
+    When `num_rows` is known the shard is preallocated as a memory-mapped
+    `.npy` and each batch is copied into place; otherwise batches are
+    appended behind a fixed-size header that is patched on `write()`.
+    Either way memory use does not grow with the shard size.
+
+    Every `checkpoint_interval` seconds the data is synced to disk and the
+    number of durable rows is recorded in `checkpoint.<shard>.json`. With
+    `resume=True` the writer reopens the shard at that row, and `self.rows`
+    tells the caller how many rows to skip.
+
+    With `progress_interval`, the rows added so far are also written to
+    `progress.<shard>.json` that often, without a sync, for a parent process
+    to report progress between checkpoints.
+
+    The row order of a stream depends on the `num_workers` and `batch_size`
+    of its DataLoader, so a streaming writer is given both as `loader`. They
+    are checkpointed with the rows each worker delivered, and a checkpoint
+    written with a different `loader` is refused on resume.
+    """
+    def __init__(self, dir_path, filename, shard_id, shard_num, num_rows=None, resume=False, checkpoint_interval=60, loader=None, progress_interval=None):
         self.dir_path = dir_path
         self.id_filename = 'ids'
         self.filename = filename
         self.shard_id = shard_id
         self.shard_num = shard_num
         self.shard_digit = int(math.log10(shard_num)) + 1
+        self.num_rows = num_rows
+        self.resume = resume
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.loader = loader
+        self.rows = 0
+        self.worker_rows = None if loader is None else [0] * max(loader['num_workers'], 1)
+        self.done = False
         self.id_file = None
-        self.__init_batch()
+        self.file = None
+        self.vectors = None
 
     def __enter__(self):
         if not os.path.exists(self.dir_path):
             os.makedirs(self.dir_path)
         shard_str = f"{str(self.shard_id).zfill(self.shard_digit)}-of-{str(self.shard_num).zfill(self.shard_digit)}"
-        self.id_file = Path(self.dir_path, f"{self.id_filename}.{shard_str}.txt").open('w')
-        self.file    = Path(self.dir_path, f"{self.filename}.{shard_str}.npy").open("wb")
+        self.id_path = Path(self.dir_path, f"{self.id_filename}.{shard_str}.txt")
+        self.path    = Path(self.dir_path, f"{self.filename}.{shard_str}.npy")
+        self.checkpoint_path = Path(self.dir_path, f"checkpoint.{shard_str}.json")
+        self.progress_path = Path(self.dir_path, f"progress.{shard_str}.json")
+
+        if self.resume and self.checkpoint_path.exists():
+            self._restore()
+        else:
+            if self.checkpoint_path.exists():
+                self.checkpoint_path.unlink()
+            self.id_file = self.id_path.open('w')
+        self.last_checkpoint = time.time()
+        if self.progress_interval is not None:
+            self.write_progress()
+        return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.id_file.close()
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+    
+    def _open(self, dim, dtype, mode='w+'):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        if self.num_rows is not None:
+            self.vectors = np.lib.format.open_memmap(
+                self.path, mode=mode, dtype=self.dtype, shape=(self.num_rows, dim)
+            )
+        elif mode == 'r+':
+            self.file = self.path.open('r+b')
+            self.file.truncate(NPY_HEADER_SIZE + self.rows * dim * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = self.path.open('wb')
+            self.file.write(npy_header(self.dtype, (0, dim)))
+
+    def _restore(self):
+        with self.checkpoint_path.open('r') as f:
+            state = json.load(f)
+        if state['num_rows'] != self.num_rows:
+            raise ValueError(
+                f"{self.checkpoint_path} was written for {state['num_rows']} rows, "
+                f"but this shard has {self.num_rows}"
+            )
+        if state.get('loader') != self.loader:
+            raise ValueError(
+                f"{self.checkpoint_path} was written with DataLoader settings {state.get('loader')}, "
+                f"but this run uses {self.loader}, keep --num_workers and --batch_size unchanged"
+            )
+        self.rows = state['rows']
+        self.worker_rows = state.get('worker_rows')
+        self.done = state['done']
+        logging.info('Resume %s from row %d', self.path, self.rows)
+
+        self.id_file = self.id_path.open('r+')
+        self.id_file.truncate(state['id_bytes'])
+        self.id_file.seek(0, os.SEEK_END)
+        if state['dim'] is not None:
+            self._open(state['dim'], state['dtype'], mode='r+')
+    
+    def rewind(self, rows):
+        """drop everything added after the first `rows` rows"""
+        if rows == self.rows:
+            return
+        self.id_file.flush()
+        with self.id_path.open('rb') as f:
+            for _ in range(rows):
+                f.readline()
+            id_bytes = f.tell()
+        self.id_file.truncate(id_bytes)
+        self.id_file.seek(0, os.SEEK_END)
+        if self.file is not None:
+            self.file.truncate(NPY_HEADER_SIZE + rows * self.dim * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        self.rows = rows
+        self.done = False
     
-    def __init_batch(self):
-        self.ids = []
-        self.embeddings = []
+    def checkpoint(self):
+        """sync everything added so far and record it as durable"""
+        if self.vectors is not None:
+            self.vectors.flush()
+        elif self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.id_file.flush()
+        os.fsync(self.id_file.fileno())
+
+        state = {
+            'rows': self.rows,
+            'num_rows': self.num_rows,
+            'id_bytes': self.id_file.tell(),
+            'dim': getattr(self, 'dim', None),
+            'dtype': getattr(self, 'dtype', np.dtype('float16')).str,
+            'done': self.done,
+            'loader': self.loader,
+            'worker_rows': self.worker_rows,
+        }
+        tmp_path = self.checkpoint_path.with_name(f"{self.checkpoint_path.name}.tmp")
+        with tmp_path.open('w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.last_checkpoint = time.time()
+        if self.progress_interval is not None:
+            self.write_progress()
+    
+    def write_progress(self):
+        """record the rows added so far, they are not durable until the next checkpoint"""
+        tmp_path = self.progress_path.with_name(f"{self.progress_path.name}.tmp")
+        with tmp_path.open('w') as f:
+            json.dump({'rows': self.rows, 'num_rows': self.num_rows, 'done': self.done}, f)
+        os.replace(tmp_path, self.progress_path)
+        self.last_progress = time.time()
     
     def add(self, batch):
-        self.ids.extend(batch['id'])
-        self.embeddings.append(batch['vector'])
+        vectors = batch['vector']
+        if self.vectors is None and self.file is None:
+            self._open(vectors.shape[1], vectors.dtype)
+        
+        end = self.rows + len(vectors)
+        if self.vectors is not None:
+            self.vectors[self.rows:end] = vectors
+        else:
+            self.file.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+        self.id_file.write(''.join(f'{_id}\n' for _id in batch['id']))
+        self.id_file.flush()
+        self.rows = end
+        if self.worker_rows is not None:
+            self.worker_rows[batch.get('worker', 0)] += len(vectors)
+
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+        elif self.progress_interval is not None and time.time() - self.last_progress >= self.progress_interval:
+            self.write_progress()
     
     def write(self):
         logging.info('Writing files ...')
-        for _id in self.ids:
-            self.id_file.write(f'{_id}\n')
-        
-        embedding_matrix = np.concatenate(self.embeddings)
-        npb = BytesIO()
-        np.save(npb, embedding_matrix)
-        self.file.write(npb.getbuffer())
+        if self.vectors is not None:
+            if self.rows != self.num_rows:
+                raise ValueError(f'Expected {self.num_rows} rows, but {self.rows} were added')
+        elif self.file is not None:
+            self.file.seek(0)
+            self.file.write(npy_header(self.dtype, (self.rows, self.dim)))
+            self.file.seek(0, os.SEEK_END)
+        else:
+            logging.warning('No embeddings were added, skip %s', self.path)
+        self.done = True
+        self.checkpoint()
         logging.info('Done')
 
 
+class SplitRouter:
+    """Send each row of a batch to the writer of its split.
+
+    `labels[i]` is the index in `writers` of the i-th row of the stream.
+    """
+    def __init__(self, writers, labels, start=0):
+        self.writers = writers
+        self.labels = labels
+        self.position = start
+    
+    def add(self, batch):
+        labels = self.labels[self.position:self.position + len(batch['id'])]
+        self.position += len(labels)
+        for code, writer in enumerate(self.writers):
+            rows = np.flatnonzero(labels == code)
+            if len(rows):
+                writer.add({'id': [batch['id'][i] for i in rows], 'vector': batch['vector'][rows]})
+    
+    def write(self):
+        for writer in self.writers:
+            writer.write()
+
+
+def select_splits(dataset, splits, shard_id, shard_num):
+    """Rows of this shard for all `splits` in collection order, and the split of each row.
+
+    Every split is sharded the way `get_split(split).shard(...)` is, so each
+    split's shard files match the ones of a single split run.
+    """
+    rows, labels = [], []
+    for code, split in enumerate(splits):
+        split_rows = np.asarray(dataset.split_index[split])
+        # the contiguous blocks of `Dataset.shard`
+        div, mod = divmod(len(split_rows), shard_num)
+        shard_start = div * shard_id + min(shard_id, mod)
+        split_rows = split_rows[shard_start:shard_start + div + (shard_id < mod)]
+        rows.append(split_rows)
+        labels.append(np.full(len(split_rows), code, dtype=np.int8))
+    rows, labels = np.concatenate(rows), np.concatenate(labels)
+    order = np.argsort(rows, kind='stable')
+    return dataset.select(rows[order]), labels[order]
+
+
+def resume_position(writers, labels):
+    """First stream position that is not durable in every split.
+
+    Writers that checkpointed past it are rewound to it.
+    """
+    start = len(labels)
+    for code, writer in enumerate(writers):
+        positions = np.flatnonzero(labels == code)
+        if writer.rows < len(positions):
+            start = min(start, positions[writer.rows])
+    for code, writer in enumerate(writers):
+        writer.rewind(int((labels[:start] == code).sum()))
+    return int(start)
+
+
+class ReorderBuffer:
+    """Hand rows to `writer` in `position` order, whatever order batches arrive in"""
+    def __init__(self, writer, start=0):
+        self.writer = writer
+        self.next_position = start
+        self.pending = {}
+    
+    def add(self, batch):
+        for position, _id, vector in zip(batch['position'], batch['id'], batch['vector']):
+            self.pending[position] = (_id, vector)
+        
+        ids, vectors = [], []
+        while self.next_position in self.pending:
+            _id, vector = self.pending.pop(self.next_position)
+            ids.append(_id)
+            vectors.append(vector)
+            self.next_position += 1
+        if ids:
+            self.writer.add({'id': ids, 'vector': np.stack(vectors)})
+    
+    def write(self):
+        if self.pending:
+            raise ValueError(f'{len(self.pending)} rows are still waiting for earlier rows')
+        self.writer.write()
+
+
+class WorkerTagger:
+    """Collate with `collator` and tag each batch with the DataLoader worker that made it"""
+    def __init__(self, collator):
+        self.collator = collator
+    
+    def __call__(self, batch):
+        batch = self.collator(batch)
+        worker_info = get_worker_info()
+        batch['worker'] = 0 if worker_info is None else worker_info.id
+        return batch
+
+
+def stream_skip(writer):
+    """Rows of a stream that `IterableDataset.skip` can drop before the DataLoader on resume.
+
+    `skip` splits its count evenly between the DataLoader workers, while the
+    DataLoader takes one batch from each worker in turn. The two agree on
+    whole rounds in which every worker delivered a full batch; the rows after
+    the last such round are left to `skip_rows`, at most one batch per worker.
+    """
+    num_workers, batch_size = max(writer.loader['num_workers'], 1), writer.loader['batch_size']
+    rounds = min(writer.rows // (num_workers * batch_size), min(writer.worker_rows) // batch_size)
+    return rounds * num_workers * batch_size
+
+
+def skip_rows(iterator, num_rows):
+    """drop the first `num_rows` rows from a stream of batches"""
+    for batch in iterator:
+        if num_rows == 0:
+            yield batch
+        elif num_rows >= len(batch['id']):
+            num_rows -= len(batch['id'])
+        else:
+            raise ValueError('Cannot resume in the middle of a batch, keep --batch_size unchanged')
+
+
+class StageTimer:
+    """Accumulate busy time per stage to report what bounds a run"""
+    def __init__(self):
+        self.busy = defaultdict(float)
+        self.start = time.perf_counter()
+    
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy[stage] += time.perf_counter() - start
+    
+    def report(self):
+        wall = time.perf_counter() - self.start
+        for stage, busy in self.busy.items():
+            logging.info('%s: %.1fs busy, %.1f%% of %.1fs', stage, busy, 100 * busy / wall, wall)
+
+
+def encode_batches(iterator, encoder, sink, timer):
+    iterator = iter(iterator)
+    while True:
+        with timer.measure('load'):
+            batch = next(iterator, None)
+        if batch is None:
+            break
+        with timer.measure('encode'):
+            batch['vector'] = encoder.encode(batch)
+        with timer.measure('write'):
+            sink.add(batch)
+
+
+def encode_batches_pipelined(iterator, encoder, sink, timer, prefetch=4):
+    """Load, encode and write in three threads connected by bounded queues.
+
+    The loading and writing threads keep the next batches ready and drain
+    finished ones while the main thread runs the model, which releases the
+    GIL inside torch ops.
+    """
+    loaded, encoded = queue.Queue(maxsize=prefetch), queue.Queue(maxsize=prefetch)
+    stop, errors = threading.Event(), []
+    done = object()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return done
+
+    def load():
+        try:
+            batches = iter(iterator)
+            while not stop.is_set():
+                with timer.measure('load'):
+                    batch = next(batches, done)
+                put(loaded, batch)
+                if batch is done:
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def write():
+        try:
+            while True:
+                batch = get(encoded)
+                if batch is done:
+                    return
+                with timer.measure('write'):
+                    sink.add(batch)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=load, daemon=True), threading.Thread(target=write, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            batch = get(loaded)
+            if batch is done:
+                break
+            with timer.measure('encode'):
+                batch['vector'] = encoder.encode(batch)
+            put(encoded, batch)
+        put(encoded, done)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
 def main(args):
 
     logging.info(f"{args}")
+    if args.bucket_by_length:
+        args.pretokenize = True
+    if args.pretokenize and (args.encode_type != 'text' or args.streaming):
+        raise ValueError('--pretokenize and --bucket_by_length only apply to text without --streaming')
+    splits = list(SPLITS) if args.split == 'all' else args.split.split(',')
+    if len(splits) > 1 and args.streaming:
+        raise ValueError('Encoding several splits in one pass needs the dataset, drop --streaming')
+    if args.threads:
+        torch.set_num_threads(args.threads)
 
     logging.info('Prepare model')
     encoder = ClipEncoder(
@@ -191,55 +742,150 @@ def main(args):
         device=args.device,
         dtype=args.dtype,
         l2_norm=True,
+        backend=args.backend,
+        onnx_dir=args.onnx_dir,
     )
 
     logging.info('Prepare data')
-    dataset = AtomicDataset(
-        data_name_or_path=args.inputs,
-        id_column=args.id_column,
-        qrel_name_or_path=args.qrels,
-    )
+    labels = None
+    if args.streaming:
+        fields = TEXT_FIELDS if args.encode_type == 'text' else [IMAGE_FIELD]
+        dataset = load_streaming_dataset(
+            args.inputs,
+            id_column=args.id_column,
+            qrel_name_or_path=args.qrels,
+            split=args.split,
+            columns=[args.id_column] + fields,
+        )
+    else:
+        dataset = AtomicDataset(
+            data_name_or_path=args.inputs,
+            id_column=args.id_column,
+            qrel_name_or_path=args.qrels,
+        )
 
-    if args.split:
-        dataset = dataset.get_split(args.split)
-    
-    # shard the data
-    dataset = dataset.shard(index=args.shard_id, num_shards=args.shard_num)
+        if len(splits) > 1:
+            # one pass over the rows of every split, each row routed to its split
+            dataset, labels = select_splits(dataset, splits, args.shard_id, args.shard_num)
+        else:
+            if args.split:
+                dataset = dataset.get_split(args.split)
+
+            # shard the data
+            dataset = dataset.shard(index=args.shard_id, num_shards=args.shard_num)
 
+    hash_content = args.embedding_cache is not None
     if args.encode_type == 'text':
         collator = TextCollator(
             id_col='text_id',
-            field_col=['page_title', 'section_title', 'hierachy', 'context_section_description', 'context_page_description'],
+            field_col=TEXT_FIELDS,
             processor=encoder.processor.tokenizer,
+            hash_content=hash_content,
         )
+        if args.pretokenize:
+            dataset = dataset.map(
+                collator.tokenize,
+                batched=True,
+                num_proc=args.num_proc,
+                remove_columns=[c for c in dataset.column_names if c != args.id_column],
+                desc='pretokenize',
+            )
+            dataset = dataset.add_column('position', np.arange(len(dataset)))
     else:
-        collator = ImageCollator(
+        if args.image_preprocess == 'pil' or hash_content:
+            # decode in the collator instead, at reduced resolution for pil,
+            # and hash the file bytes for the embedding cache
+            dataset = dataset.cast_column(IMAGE_FIELD, ImageFeature(decode=False))
+        collator_class = FastImageCollator if args.image_preprocess == 'pil' else ImageCollator
+        collator = collator_class(
             id_col='image_id',
-            field_col='image',
+            field_col=IMAGE_FIELD,
             processor=encoder.processor.image_processor,
+            hash_content=hash_content,
         )
-    
-    iterator = DataLoader(
-        dataset,
-        batch_size=args.batch_size,
-        shuffle=False,
-        drop_last=False,
-        collate_fn=collator,
-        num_workers=args.num_workers,
-        pin_memory=True,
-    )
+    if args.streaming:
+        collator = WorkerTagger(collator)
 
+    if hash_content:
+        # everything that changes the embedding of the same content
+        namespace = f'{args.encoder}|{args.encode_type}|{args.dtype}|{args.backend}'
+        if args.encode_type == 'image':
+            namespace += f'|{args.image_preprocess}'
+        encoder = CachedEncoder(encoder, EmbeddingCache(args.embedding_cache, namespace))
+    
     logging.info('Encode data')
-    output_dir = Path(args.output_dir, args.encode_type, args.split)    
     filename = 'embeddings'
-    writer = NumpyWriter(dir_path=output_dir, filename=filename, shard_id=args.shard_id, shard_num=args.shard_num)
-    
-    with writer:
-        for batch in tqdm(iterator, total=len(iterator), desc='encode ...'):
-            embeddings = encoder.encode(batch)
-            batch['vector'] = embeddings
-            writer.add(batch)
-        writer.write()
+    writers = []
+    for code, split in enumerate(splits):
+        output_dir = Path(args.output_dir, args.encode_type, split)
+        if args.streaming:
+            num_rows = None
+        elif labels is not None:
+            num_rows = int((labels == code).sum())
+        else:
+            num_rows = len(dataset)
+        writers.append(NumpyWriter(
+            dir_path=output_dir, filename=filename, shard_id=args.shard_id, shard_num=args.shard_num,
+            num_rows=num_rows, resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+            loader=dict(num_workers=args.num_workers, batch_size=args.batch_size) if args.streaming else None,
+            progress_interval=args.progress_interval,
+        ))
+    
+    with ExitStack() as stack:
+        for writer in writers:
+            stack.enter_context(writer)
+        if all(writer.done for writer in writers):
+            logging.info('Shard is already complete')
+            return
+
+        if labels is not None:
+            start = resume_position(writers, labels)
+            sink = SplitRouter(writers, labels, start)
+        else:
+            start = writers[0].rows
+            sink = writers[0]
+
+        skipped = start
+        if args.streaming:
+            # whole rounds of batches are skipped without being read. `skip`
+            # goes before the node split, which hands each node its share;
+            # a node split that deals out rows one by one cannot be followed
+            skipped = stream_skip(writers[0]) if start and dataset.n_shards % args.shard_num == 0 else 0
+            if skipped:
+                dataset = dataset.skip(skipped * args.shard_num)
+            # shard the data
+            dataset = split_dataset_by_node(dataset, rank=args.shard_id, world_size=args.shard_num)
+        elif start:
+            dataset = dataset.select(range(start, len(dataset)))
+
+        if args.bucket_by_length:
+            batching = dict(batch_sampler=LengthBucketBatchSampler(dataset['length'], args.batch_size, args.bucket_size))
+        else:
+            batching = dict(batch_size=args.batch_size, shuffle=False, drop_last=False)
+        iterator = DataLoader(
+            dataset,
+            collate_fn=collator,
+            num_workers=args.num_workers,
+            pin_memory=True,
+            **batching,
+        )
+        total = None if args.streaming else len(iterator)
+        if start > skipped:
+            # the rest of the rows that are already written are read past
+            iterator = skip_rows(iterator, start - skipped)
+
+        if args.bucket_by_length:
+            sink = ReorderBuffer(sink, start)
+        iterator = tqdm(iterator, total=total, desc='encode ...')
+        timer = StageTimer()
+        if args.pipeline:
+            encode_batches_pipelined(iterator, encoder, sink, timer, prefetch=args.prefetch)
+        else:
+            encode_batches(iterator, encoder, sink, timer)
+        sink.write()
+        timer.report()
+        if hash_content:
+            encoder.report()
 
 if __name__ == "__main__":
     parser = get_args_parser()
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+from pathlib import Path
+from tqdm.auto import tqdm
+
+from encode import get_args_parser as get_encode_args_parser
+from src.data import SPLITS
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+MANIFEST = 'manifest.json'
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(
+        'Encode embeddings with one local process per shard',
+        parents=[get_encode_args_parser()],
+    )
+    parser.add_argument('--num_procs', type=int, default=None, help='number of shard workers, default: cores / threads_per_proc')
+    parser.add_argument('--threads_per_proc', type=int, default=1, help='compute threads of each worker')
+    parser.add_argument('--pin_cpus', action='store_true', help='pin each worker to its own cores')
+    parser.add_argument('--poll_interval', type=float, default=5)
+    parser.add_argument('--merged_dir', type=str, default=None, help='default: <output_dir>/<encode_type>/<split>-merged, a single split only')
+    parser.add_argument('--no_merge', action='store_true')
+    # one loader process per shard, the shards already keep every core busy
+    parser.set_defaults(num_workers=1)
+    return parser
+
+
+def to_argv(args):
+    """turn parsed encode.py arguments back into a command line"""
+    argv = []
+    for action in get_encode_args_parser()._actions:
+        value = getattr(args, action.dest, None)
+        if value is None or value is False or not action.option_strings:
+            continue
+        argv.append(action.option_strings[0])
+        if value is not True:
+            argv.append(str(value))
+    return argv
+
+
+def launch(args, shard_id, log_dir):
+    cmd = [sys.executable, str(Path(Path(__file__).parent, 'encode.py'))]
+    cmd += to_argv(args)
+    cmd += ['--shard_id', str(shard_id), '--shard_num', str(args.num_procs), '--threads', str(args.threads_per_proc)]
+
+    # keep every library in the worker to its own thread budget
+    env = dict(os.environ)
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        env[name] = str(args.threads_per_proc)
+    env['TOKENIZERS_PARALLELISM'] = 'false'
+
+    preexec_fn = None
+    if args.pin_cpus and hasattr(os, 'sched_setaffinity'):
+        num_cpus = os.cpu_count()
+        cpus = {(shard_id * args.threads_per_proc + i) % num_cpus for i in range(args.threads_per_proc)}
+        preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+
+    log_file = Path(log_dir, f'shard-{shard_id}.log').open('w')
+    proc = subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+    proc.log_file = log_file
+    return proc
+
+
+def shard_str(shard_id, shard_num):
+    """shard name used in the files of encode.py's NumpyWriter"""
+    shard_digit = len(str(shard_num))
+    return f"{str(shard_id).zfill(shard_digit)}-of-{str(shard_num).zfill(shard_digit)}"
+
+
+def read_progress(shard_dirs, shard_num):
+    """progress files of this run's shards, leftovers of runs with another shard count are ignored"""
+    states = []
+    paths = [Path(shard_dir, f'progress.{shard_str(shard_id, shard_num)}.json') for shard_dir in shard_dirs for shard_id in range(shard_num)]
+    for path in paths:
+        try:
+            with path.open('r') as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            # not written yet, pick it up on the next poll
+            continue
+    return states
+
+
+def wait(procs, shard_dirs, poll_interval):
+    progress = tqdm(desc='encode ...', unit='rows')
+    while any(proc.poll() is None for proc in procs):
+        states = read_progress(shard_dirs, len(procs))
+        num_rows = [state['num_rows'] for state in states]
+        if len(states) == len(procs) * len(shard_dirs) and None not in num_rows:
+            progress.total = sum(num_rows)
+        progress.n = sum(state['rows'] for state in states)
+        progress.refresh()
+        time.sleep(poll_interval)
+    progress.close()
+
+    for proc in procs:
+        proc.log_file.close()
+    return [proc.returncode for proc in procs]
+
+
+def validate_shards(shard_dir, shard_num):
+    """check every shard is complete and consistent, return them in shard order"""
+    shards = []
+    for shard_id in range(shard_num):
+        name = shard_str(shard_id, shard_num)
+        with Path(shard_dir, f'checkpoint.{name}.json').open('r') as f:
+            state = json.load(f)
+        if not state['done']:
+            raise ValueError(f'Shard {name} is not complete')
+
+        shard = {'embeddings': f'embeddings.{name}.npy', 'ids': f'ids.{name}.txt', 'rows': state['rows']}
+        with Path(shard_dir, shard['ids']).open('r') as f:
+            num_ids = sum(1 for _ in f)
+        if state['rows'] == 0 and num_ids == 0:
+            continue
+        vectors = np.load(Path(shard_dir, shard['embeddings']), mmap_mode='r')
+        if not (len(vectors) == num_ids == state['rows']):
+            raise ValueError(f'Shard {name} has {len(vectors)} vectors and {num_ids} ids, expected {state["rows"]}')
+        shard['dim'] = vectors.shape[1]
+        shard['dtype'] = vectors.dtype.str
+        shards.append(shard)
+
+    if len({(shard['dim'], shard['dtype']) for shard in shards}) > 1:
+        raise ValueError('Shards disagree on the embedding dim or dtype')
+    return shards
+
+
+def write_manifest(dir_path, shards, **meta):
+    manifest = {
+        'rows': sum(shard['rows'] for shard in shards),
+        'dim': shards[0]['dim'] if shards else None,
+        'dtype': shards[0]['dtype'] if shards else None,
+        'shards': [{k: shard[k] for k in ['embeddings', 'ids', 'rows']} for shard in shards],
+        **meta,
+    }
+    tmp_path = Path(dir_path, f'{MANIFEST}.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, Path(dir_path, MANIFEST))
+    return manifest
+
+
+def merge_shards(shard_dir, shards, merged_dir, block_size=65536, **meta):
+    Path(merged_dir).mkdir(parents=True, exist_ok=True)
+    num_rows = sum(shard['rows'] for shard in shards)
+    merged = np.lib.format.open_memmap(
+        Path(merged_dir, 'embeddings.npy'), mode='w+',
+        dtype=np.dtype(shards[0]['dtype']), shape=(num_rows, shards[0]['dim']),
+    )
+
+    offset = 0
+    with Path(merged_dir, 'ids.txt').open('w') as f_out:
+        for shard in tqdm(shards, desc='merge ...'):
+            vectors = np.load(Path(shard_dir, shard['embeddings']), mmap_mode='r')
+            for start in range(0, len(vectors), block_size):
+                block = vectors[start:start + block_size]
+                merged[offset:offset + len(block)] = block
+                offset += len(block)
+            with Path(shard_dir, shard['ids']).open('r') as f_in:
+                for line in f_in:
+                    f_out.write(line)
+    merged.flush()
+
+    merged_shard = dict(shards[0], embeddings='embeddings.npy', ids='ids.txt', rows=num_rows)
+    return write_manifest(merged_dir, [merged_shard], **meta)
+
+
+def main(args):
+    if args.num_procs is None:
+        args.num_procs = max(1, os.cpu_count() // args.threads_per_proc)
+    if args.progress_interval is None:
+        # checkpoints are synced and too far apart for the progress bar
+        args.progress_interval = args.poll_interval
+    logging.info(f"{args}")
+
+    splits = list(SPLITS) if args.split == 'all' else args.split.split(',')
+    if args.merged_dir and len(splits) > 1:
+        raise ValueError('--merged_dir needs a single split')
+    shard_dirs = [Path(args.output_dir, args.encode_type, split) for split in splits]
+    log_dir = Path(shard_dirs[0], 'logs')
+    log_dir.mkdir(parents=True, exist_ok=True)
+    for shard_dir in shard_dirs:
+        for shard_id in range(args.num_procs):
+            # the workers write theirs once they open their shard
+            Path(shard_dir, f'progress.{shard_str(shard_id, args.num_procs)}.json').unlink(missing_ok=True)
+
+    logging.info('Launch %d shard workers, logs in %s', args.num_procs, log_dir)
+    procs = [launch(args, shard_id, log_dir) for shard_id in range(args.num_procs)]
+    try:
+        returncodes = wait(procs, shard_dirs, args.poll_interval)
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+        raise
+
+    failed = [shard_id for shard_id, code in enumerate(returncodes) if code != 0]
+    if failed:
+        logging.error('Shards %s failed, see their logs; rerun with --resume to continue', failed)
+        sys.exit(1)
+
+    for split, shard_dir in zip(splits, shard_dirs):
+        logging.info('Validate %s shards', split)
+        shards = validate_shards(shard_dir, args.num_procs)
+        if not shards:
+            logging.warning('No %s embeddings were written', split)
+            continue
+        meta = {'inputs': args.inputs, 'encoder': args.encoder, 'split': split}
+        write_manifest(shard_dir, shards, **meta)
+
+        if not args.no_merge:
+            merged_dir = args.merged_dir or Path(args.output_dir, args.encode_type, f'{split}-merged')
+            logging.info('Merge shards into %s', merged_dir)
+            merge_shards(shard_dir, shards, merged_dir, **meta)
+    logging.info('Done')
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
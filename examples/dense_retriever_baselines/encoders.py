@@ -1,9 +1,13 @@
+import inspect
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 from torch import autocast
 from transformers import CLIPModel, CLIPProcessor
 from contextlib import nullcontext
+from pathlib import Path
 
+BACKENDS = ['eager', 'compile', 'int8', 'onnx']
 
 
 def prepare_inputs(inputs: dict, device: str):
@@ -12,6 +16,69 @@ def prepare_inputs(inputs: dict, device: str):
     return inputs
 
 
+class TextTower(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+
+class VisionTower(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+def export_onnx(model, processor, encode_type, path):
+    """export the text or vision tower of a CLIP model with dynamic batch (and sequence) axes"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if encode_type == 'text':
+        tower = TextTower(model)
+        # real token ids, so the eos pooling is traced on a padded batch
+        dummy = processor.tokenizer(
+            ['a photo', 'a photo of a cat'], padding='max_length', max_length=77, return_tensors='pt'
+        )
+        args = (dummy['input_ids'], dummy['attention_mask'])
+        input_names = ['input_ids', 'attention_mask']
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    else:
+        tower = VisionTower(model)
+        size = model.config.vision_config.image_size
+        args = (torch.zeros((2, 3, size, size)),)
+        input_names = ['pixel_values']
+        dynamic_axes = {'pixel_values': {0: 'batch'}}
+    dynamic_axes['embeddings'] = {0: 'batch'}
+
+    # newer torch defaults to the dynamo exporter, keep the TorchScript one
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            tower.eval(), args, str(path),
+            input_names=input_names,
+            output_names=['embeddings'],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            **kwargs,
+        )
+
+
+def cosine_drift(reference, candidate):
+    """cosine similarity between matching rows of two embedding matrices"""
+    reference = F.normalize(torch.as_tensor(reference, dtype=torch.float32), dim=-1)
+    candidate = F.normalize(torch.as_tensor(candidate, dtype=torch.float32), dim=-1)
+    cosine = (reference * candidate).sum(dim=-1)
+    return {
+        'mean_cosine': cosine.mean().item(),
+        'min_cosine': cosine.min().item(),
+        'max_drift': (1 - cosine).max().item(),
+    }
+
+
 class ClipEncoder:
     def __init__(
         self,
@@ -20,6 +87,8 @@ class ClipEncoder:
         dtype: str = 'bf16',
         l2_norm: bool = True, 
         encode_type: str = None,
+        backend: str = 'eager',
+        onnx_dir: str = 'onnx',
     ):
         self.device = torch.device(device)
         
@@ -39,17 +108,45 @@ class ClipEncoder:
         self.model.eval()
         self.model.to(self.device)
 
-    def encode(self, inputs, **kwargs):
-        
-        if self.dtype == torch.float32:
+        self.backend = backend
+        if backend == 'compile':
+            if not hasattr(torch, 'compile'):
+                raise ValueError('backend=compile requires torch>=2.0')
+            self.model.text_model = torch.compile(self.model.text_model, dynamic=True)
+            self.model.vision_model = torch.compile(self.model.vision_model)
+        elif backend == 'int8':
+            if self.device.type != 'cpu':
+                raise ValueError('backend=int8 only runs on cpu')
+            # weights of every linear layer in int8, activations quantized on the fly
+            self.model = torch.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        elif backend == 'onnx':
+            import onnxruntime
+
+            self.sessions = {}
+            for tower in ['text', 'image'] if encode_type is None else [encode_type]:
+                path = Path(onnx_dir, model_name.replace('/', '--'), f'{tower}.onnx')
+                if not path.exists():
+                    export_onnx(self.model, self.processor, tower, path)
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = torch.get_num_threads()
+                self.sessions[tower] = onnxruntime.InferenceSession(
+                    str(path), options, providers=['CPUExecutionProvider']
+                )
+        elif backend != 'eager':
+            raise ValueError(f'Unknown backend: {backend}')
+
+    def encode(self, inputs, encode_type=None, **kwargs):
+        """encode a batch of `encode_type` inputs, default: the type the encoder was built for"""
+        encode_type = encode_type or self.encode_type
+        if self.dtype == torch.float32 or self.backend in ['int8', 'onnx']:
             context = nullcontext()
         else:
             context = autocast(device_type=self.device.type, dtype=self.dtype)
 
         with context:
-            if self.encode_type == 'text':
+            if encode_type == 'text':
                 embeddings = self.get_text_features(inputs['text'])
-            elif self.encode_type == 'image':
+            elif encode_type == 'image':
                 embeddings = self.get_image_features(inputs['image'])
             else:
                 raise NotImplementedError
@@ -61,14 +158,23 @@ class ClipEncoder:
 
         return embeddings
     
+    def run_onnx(self, tower, inputs):
+        inputs = {k: v.cpu().numpy() for k, v in inputs.items()}
+        embeddings, = self.sessions[tower].run(None, inputs)
+        return torch.from_numpy(embeddings).to(self.device)
+
     @torch.no_grad()
     def get_text_features(self, inputs):
+        if self.backend == 'onnx':
+            return self.run_onnx('text', {k: inputs[k] for k in ['input_ids', 'attention_mask']})
         model_inputs = prepare_inputs(inputs, device=self.device)
         embeddings = self.model.get_text_features(**model_inputs)
         return embeddings
     
     @torch.no_grad()
     def get_image_features(self, inputs):
+        if self.backend == 'onnx':
+            return self.run_onnx('image', {'pixel_values': inputs['pixel_values']})
         model_inputs = prepare_inputs(inputs, self.device)
         embeddings = self.model.get_image_features(**model_inputs)
         return embeddings
\ No newline at end of file
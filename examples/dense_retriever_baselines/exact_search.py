@@ -0,0 +1,59 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def merge_top_k(scores, labels, tile_scores, offset, k):
+    """merge the top-k of a score tile into the running top-k `scores`/`labels`, in place"""
+    tile_k = min(k, tile_scores.shape[1])
+    top = np.argpartition(-tile_scores, tile_k - 1, axis=1)[:, :tile_k]
+    candidate_scores = np.concatenate([scores, np.take_along_axis(tile_scores, top, axis=1)], axis=1)
+    candidate_labels = np.concatenate([labels, top + offset], axis=1)
+    best = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+    scores[:] = np.take_along_axis(candidate_scores, best, axis=1)
+    labels[:] = np.take_along_axis(candidate_labels, best, axis=1)
+
+
+class ExactSearcher:
+    """Exact inner-product top-k over an embedding store, without an index.
+
+    Documents are streamed from the memory-mapped shards of `reader` (a
+    `readers.NumpyReader`) in tiles of `tile_size` rows. Each tile is cast
+    to float32 once and scored against the whole query batch with a single
+    GEMM, which BLAS spreads over all cores. The per-query top-k of the tile
+    is picked with `argpartition` and merged into the running top-k, split
+    over `threads` query chunks. Memory is bounded by one tile and its
+    queries x `tile_size` score matrix. Needs nothing but NumPy.
+    """
+    def __init__(self, reader, tile_size=16384, threads=None):
+        self.reader = reader
+        self.tile_size = tile_size
+        self.threads = threads or os.cpu_count()
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.dimension = reader.dim
+        self.num_docs = len(reader)
+
+    @property
+    def docids(self):
+        return self.reader.ids
+
+    def search_arrays(self, queries, k=10, threads=None):
+        """return (scores, labels) of the top-k rows for each query, best first, labels are rows of `reader`"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        chunks = [chunk for chunk in np.array_split(np.arange(len(queries)), threads or self.threads) if len(chunk)]
+        chunks = [slice(chunk[0], chunk[-1] + 1) for chunk in chunks]
+
+        offset = 0
+        for block in self.reader.iter_blocks(self.tile_size):
+            tile = np.asarray(block['vector'], dtype=np.float32)
+            tile_scores = queries @ tile.T
+            list(self.pool.map(lambda rows: merge_top_k(scores[rows], labels[rows], tile_scores[rows], offset, k), chunks))
+            offset += len(tile)
+
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,120 @@
+import math
+import heapq
+import argparse
+import itertools
+from operator import itemgetter
+from tqdm.auto import tqdm
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Fuse TREC runs sorted by topic in one streaming pass')
+    parser.add_argument('--runs', type=str, nargs='+', help="runs sorted by topic, e.g. with `LC_ALL=C sort -s -k1,1`")
+    parser.add_argument('--method', type=str, default='rrf', choices=['rrf', 'combsum', 'weighted'], help='weighted: combsum with --weights scaled to sum to 1')
+    parser.add_argument('--weights', type=float, nargs='+', default=None, help='one weight per run, default: 1')
+    parser.add_argument('--normalize', type=str, default='minmax', choices=['none', 'minmax', 'zscore'], help='per run and topic score normalization for combsum and weighted')
+    parser.add_argument('--rrf_k', type=int, default=60)
+    parser.add_argument('--depth', type=int, default=1000, help='hits read from each run per topic')
+    parser.add_argument('--hits', type=int, default=1000)
+    parser.add_argument('--output', type=str)
+    parser.add_argument('--output_tag', type=str, default='fusion')
+    return parser
+
+
+def best_first(hits):
+    """sort (docid, score) hits by score, keeping the order of ties; nearly free on runs already in rank order"""
+    hits.sort(key=itemgetter(1), reverse=True)
+    return hits
+
+
+def read_run(path, depth):
+    """Yield (topic_id, [(docid, score)]) for each topic of a run, best first.
+
+    Only one topic is held at a time, so topics must come in sorted order;
+    a topic out of order raises `ValueError`.
+    """
+    topic_id, hits = None, []
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] != topic_id:
+                if topic_id is not None:
+                    if fields[0] < topic_id:
+                        raise ValueError(f'{path} is not sorted by topic ({fields[0]} after {topic_id}), sort it with `LC_ALL=C sort -s -k1,1`')
+                    yield topic_id, best_first(hits)[:depth]
+                topic_id, hits = fields[0], []
+            hits.append((fields[2], float(fields[4])))
+    if topic_id is not None:
+        yield topic_id, best_first(hits)[:depth]
+
+
+def merge_runs(runs):
+    """k-way merge of `read_run` iterators, yield (topic_id, [(run, hits)]) with the runs that have the topic"""
+    tagged = [zip(itertools.repeat(run), hits_by_topic) for run, hits_by_topic in enumerate(runs)]
+    merged = heapq.merge(*tagged, key=lambda item: (item[1][0], item[0]))
+    for topic_id, items in itertools.groupby(merged, key=lambda item: item[1][0]):
+        yield topic_id, [(run, hits) for run, (_, hits) in items]
+
+
+def normalize(scores, method):
+    if method == 'minmax':
+        lo, hi = min(scores), max(scores)
+        return [(score - lo) / (hi - lo) if hi > lo else 1.0 for score in scores]
+    if method == 'zscore':
+        mean = sum(scores) / len(scores)
+        std = math.sqrt(sum((score - mean) ** 2 for score in scores) / len(scores))
+        return [(score - mean) / std if std > 0 else 0.0 for score in scores]
+    return scores
+
+
+def fuse(run_hits, weights, method, norm, rrf_k):
+    """fused (docid, score) of one topic, best first, ties broken by docid"""
+    fused = {}
+    for run, hits in run_hits:
+        if method == 'rrf':
+            scores = [1 / (rrf_k + rank) for rank in range(1, len(hits) + 1)]
+        else:
+            scores = normalize([score for _, score in hits], norm)
+        for (docid, _), score in zip(hits, scores):
+            fused[docid] = fused.get(docid, 0.0) + weights[run] * score
+    # sorting by docid first breaks score ties by docid, both sorts stay in C
+    return best_first(sorted(fused.items()))
+
+
+def main(args):
+    logging.info(f"{args}")
+    weights = args.weights or [1.0] * len(args.runs)
+    if len(weights) != len(args.runs):
+        raise ValueError(f'{len(args.runs)} runs but {len(weights)} weights')
+    if args.method == 'weighted':
+        if args.weights is None:
+            raise ValueError('--method weighted needs --weights')
+        weights = [weight / sum(weights) for weight in weights]
+
+    runs = [read_run(path, args.depth) for path in args.runs]
+    num_topics = 0
+    with open(args.output, 'w') as f_out:
+        for topic_id, run_hits in tqdm(merge_runs(runs), desc='fuse'):
+            hits = fuse(run_hits, weights, args.method, args.normalize, args.rrf_k)
+            # same line format as the TREC writer of pyserini
+            f_out.writelines(
+                f'{topic_id} Q0 {docid} {rank} {score:.6f} {args.output_tag}\n'
+                for rank, (docid, score) in enumerate(hits[:args.hits], start=1)
+            )
+            num_topics += 1
+    logging.info('Fused %d topics of %d runs into %s', num_topics, len(args.runs), args.output)
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -1,9 +1,15 @@
+import json
+import time
 import argparse
+import multiprocessing
 import faiss
 import numpy as np
 from pathlib import Path
 from tqdm.auto import tqdm
 
+from readers import NumpyReader
+from exact_search import ExactSearcher
+
 import logging
 
 # Configure the logger
@@ -16,41 +22,161 @@ def get_args_parser():
     parser = argparse.ArgumentParser('Index embeddings', add_help=False)
     parser.add_argument('--embedding_dir', type=str)
     parser.add_argument('--index', type=str)
-    parser.add_argument('--index_type', type=str, default='flat')
+    parser.add_argument('--index_type', type=str, default='flat', help="'flat', 'fp16', 'sq8' or a faiss factory string, e.g. IVF4096,Flat / IVF4096,PQ64 / HNSW32 / OPQ64,IVF4096,PQ64")
+    parser.add_argument('--block_size', type=int, default=65536, help='vectors read, cast and added per call')
+    parser.add_argument('--train_size', type=int, default=262144, help='vectors sampled from the shards to train the index')
+    parser.add_argument('--ef_construction', type=int, default=None, help='HNSW build-time beam width')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--recall_queries', type=int, default=0, help='report recall against exact search on this many sampled queries')
+    parser.add_argument('--recall_topics', type=str, default=None, help='embedding dir to sample the queries from, default: --embedding_dir')
+    parser.add_argument('--recall_k', type=int, default=100)
+    parser.add_argument('--search_params', type=str, nargs='*', default=None, help='faiss search parameters to report recall for, e.g. nprobe=16 efSearch=128')
+    parser.add_argument('--sharded', action='store_true', help='one sub-index per embedding shard, searched with searchers.ShardedSearcher')
+    parser.add_argument('--num_procs', type=int, default=None, help='processes building sub-indexes, default: one per core')
     return parser
 
 
-class NumpyReader:
-    def __init__(self, embedding_dir):
-        self.embedding_dir = embedding_dir
-        vec_files = list(Path(self.embedding_dir).glob('embeddings*.npy'))
-        self.vec_files = sorted(vec_files)
-        id_files = Path(embedding_dir).glob('ids*.txt')
-        self.id_files = sorted(id_files)
-        self.load_embeddings()
-        self.dim = self.vectors.shape[1]
-
-        
-    def load_embeddings(self):
-        self.vectors = []
-        self.ids = []
-        for f in tqdm(self.vec_files, total=len(self.vec_files)):
-            self.vectors.append(np.load(f))
-        
-        self.vectors = np.concatenate(self.vectors)
-    
-        for _id in tqdm(self.id_files, total=len(self.id_files)):
-            with open(_id, 'r') as f_id:
-                _ids = [l.strip('\n') for l in f_id.readlines()]
-                self.ids.extend(_ids)   
-    
-    def __iter__(self):
-        for _id, vec in zip(self.ids, self.vectors):
-            yield {'id': _id, 'vector': vec}
-    
-    def __len__(self):
-        return len(self.ids)
-
+# shorthands for the scalar quantizers, vectors are scored in their stored format
+INDEX_TYPES = {'fp16': 'SQfp16', 'sq8': 'SQ8'}
+
+
+def index_dir_name(index, index_type):
+    return f"{index}.faiss.{index_type.replace(',', '_')}"
+
+
+def sample_rows(num_rows, size, seed):
+    """sorted random rows, so memory-mapped reads go front to back"""
+    if size >= num_rows:
+        return np.arange(num_rows)
+    return np.sort(np.random.default_rng(seed).choice(num_rows, size, replace=False))
+
+
+def add_vectors(index, vectors):
+    """Add a block of vectors to `index`.
+
+    An fp16 scalar quantizer stores the IEEE half floats as they are, so
+    fp16 blocks are copied in as codes without a float32 copy.
+    """
+    if (
+        vectors.dtype == np.float16
+        and isinstance(index, faiss.IndexScalarQuantizer)
+        and index.sq.qtype == faiss.ScalarQuantizer.QT_fp16
+    ):
+        index.add_sa_codes(np.ascontiguousarray(vectors).view(np.uint8))
+    else:
+        index.add(np.ascontiguousarray(vectors, dtype='float32'))
+
+
+def build_index(index, reader, output_dir, block_size, shard_ids=None, progress=True):
+    """add the vectors of `reader` to a trained `index`, write it and its docid file to `output_dir`"""
+    Path(output_dir).mkdir(exist_ok=True, parents=True)
+    with Path(output_dir, 'docid').open('w') as f_id, tqdm(total=len(reader), disable=not progress) as bar:
+        for block in reader.iter_blocks(block_size, shard_ids=shard_ids):
+            # at most one cast and one call per block
+            add_vectors(index, block['vector'])
+            f_id.write(''.join(f"{_id}\n" for _id in block['id']))
+            bar.update(len(block['id']))
+    faiss.write_index(index, str(Path(output_dir, 'index')))
+    return index
+
+
+def build_shard(embedding_dir, trained_path, output_dir, block_size, shard_id):
+    """process entry point, adds one embedding shard to a copy of the trained index"""
+    faiss.omp_set_num_threads(1)
+    index = faiss.read_index(str(trained_path))
+    build_index(index, NumpyReader(embedding_dir), output_dir, block_size, shard_ids=[shard_id], progress=False)
+    return shard_id, index.ntotal
+
+
+def build_shard_job(job):
+    """`build_shard` for `Pool.imap_unordered`, which passes one argument"""
+    return build_shard(*job)
+
+
+def build_sharded_index(index, reader, output_dir, block_size, num_procs=None):
+    """Build one sub-index per embedding shard in parallel processes.
+
+    Every sub-index starts from the same trained `index`, so they share
+    their quantizers. `shards.json` lists the sub-index directories in
+    store order.
+    """
+    Path(output_dir).mkdir(exist_ok=True, parents=True)
+    trained_path = Path(output_dir, 'trained.index')
+    faiss.write_index(index, str(trained_path))
+
+    shard_dirs = [f'shard-{shard_id:04d}' for shard_id in range(len(reader.shards))]
+    jobs = [
+        (reader.embedding_dir, trained_path, Path(output_dir, shard_dir), block_size, shard_id)
+        for shard_id, shard_dir in enumerate(shard_dirs)
+    ]
+    # spawn, faiss' OpenMP threads do not survive a fork
+    with multiprocessing.get_context('spawn').Pool(num_procs) as pool:
+        # unordered, the bar moves as soon as any shard is done
+        for shard_id, ntotal in tqdm(pool.imap_unordered(build_shard_job, jobs), total=len(jobs)):
+            logging.info('%s: %d vectors', shard_dirs[shard_id], ntotal)
+    trained_path.unlink()
+
+    with Path(output_dir, 'shards.json').open('w') as f:
+        json.dump({'shards': shard_dirs}, f, indent=2)
+
+
+def read_sharded_index(output_dir):
+    """the sub-indexes as one faiss.IndexShards with store-order labels"""
+    with Path(output_dir, 'shards.json').open('r') as f:
+        shard_dirs = json.load(f)['shards']
+    sub_indexes = [faiss.read_index(str(Path(output_dir, shard_dir, 'index'))) for shard_dir in shard_dirs]
+    index = faiss.IndexShards(sub_indexes[0].d, True, True)
+    for sub_index in sub_indexes:
+        # the faiss wrapper keeps a reference to each shard
+        index.add_shard(sub_index)
+    return index
+
+
+def extract_index_hnsw(index):
+    """the `IndexHNSW` of an index, behind pretransforms, id maps, refinement or as IVF quantizer, or None"""
+    index = faiss.downcast_index(index)
+    while not isinstance(index, faiss.IndexHNSW):
+        if isinstance(index, (faiss.IndexPreTransform, faiss.IndexIDMap)):
+            index = faiss.downcast_index(index.index)
+        elif isinstance(index, faiss.IndexRefine):
+            index = faiss.downcast_index(index.base_index)
+        elif faiss.try_extract_index_ivf(index) is not None:
+            index = faiss.downcast_index(faiss.extract_index_ivf(index).quantizer)
+        else:
+            return None
+    return index
+
+
+def default_search_params(index):
+    """a sweep over the search-time knob of the index, if it has one"""
+    if faiss.try_extract_index_ivf(index) is not None:
+        nlist = faiss.extract_index_ivf(index).nlist
+        return [f'nprobe={nprobe}' for nprobe in [1, 4, 16, 64, 256] if nprobe <= nlist]
+    if extract_index_hnsw(index) is not None:
+        return [f'efSearch={ef}' for ef in [16, 32, 64, 128, 256]]
+    return ['']
+
+
+def recall_report(index, reader, queries, k, search_params):
+    """recall@k against exact search and queries/sec for each setting of `search_params`"""
+    logging.info('Exact search for %d queries', len(queries))
+    _, truth = ExactSearcher(reader).search_arrays(queries, k)
+    parameter_space = faiss.ParameterSpace()
+    report = []
+    for params in search_params:
+        if params:
+            parameter_space.set_index_parameters(index, params)
+        start = time.perf_counter()
+        _, labels = index.search(queries, k)
+        elapsed = time.perf_counter() - start
+        hits = sum(len(np.intersect1d(found[found >= 0], expected[expected >= 0])) for found, expected in zip(labels, truth))
+        report.append({
+            'params': params,
+            f'recall@{k}': hits / max(int((truth >= 0).sum()), 1),
+            'qps': len(queries) / elapsed,
+        })
+        logging.info('%s recall@%d %.4f, %.1f queries/sec', params or 'default', k, report[-1][f'recall@{k}'], report[-1]['qps'])
+    return report
 
 
 def main(args):
@@ -61,25 +187,46 @@ def main(args):
 
     if args.index_type == 'flat':
         index_factory = faiss.IndexFlatIP(vector_dim)
+    else:
+        factory_string = INDEX_TYPES.get(args.index_type, args.index_type)
+        index_factory = faiss.index_factory(vector_dim, factory_string, faiss.METRIC_INNER_PRODUCT)
+        if args.ef_construction is not None:
+            index_hnsw = extract_index_hnsw(index_factory)
+            if index_hnsw is None:
+                raise ValueError(f'--ef_construction needs an HNSW index, {factory_string} has none')
+            index_hnsw.hnsw.efConstruction = args.ef_construction
     
     index_factory.verbose = True
 
-    logging.info('Add vectors to faiss index')
-    _ids = []
-    for item in tqdm(embedding_reader):
-        vector = item['vector']
-        index_factory.add(vector.reshape((1, -1)).astype('float32'))
-        _ids.append(item['id'])
-
-    output_dir = Path(f"{args.index}.faiss.{args.index_type}")
+    output_dir = Path(index_dir_name(args.index, args.index_type))
+    if args.sharded:
+        output_dir = Path(f'{output_dir}.sharded')
     if not output_dir.exists():
         output_dir.mkdir(exist_ok=True, parents=True)
 
-    faiss.write_index(index_factory, str(Path(output_dir, 'index')))
-    
-    with Path(output_dir, 'docid').open('w') as f_id:
-        for _id in _ids:
-            f_id.write(f"{_id}\n")
+    if not index_factory.is_trained:
+        rows = sample_rows(len(embedding_reader), args.train_size, args.seed)
+        logging.info('Train on %d sampled vectors', len(rows))
+        index_factory.train(embedding_reader.get_vectors(rows).astype('float32'))
+
+    logging.info('Add vectors to faiss index')
+    if args.sharded:
+        build_sharded_index(index_factory, embedding_reader, output_dir, args.block_size, args.num_procs)
+        index = read_sharded_index(output_dir)
+        index_size = sum(f.stat().st_size for f in output_dir.glob('shard-*/index'))
+    else:
+        index = build_index(index_factory, embedding_reader, output_dir, args.block_size)
+        index_size = Path(output_dir, 'index').stat().st_size
+    logging.info('Index size: %.1f MB', index_size / 2**20)
+
+    if args.recall_queries:
+        topic_reader = NumpyReader(args.recall_topics) if args.recall_topics else embedding_reader
+        rows = sample_rows(len(topic_reader), args.recall_queries, args.seed + 1)
+        queries = topic_reader.get_vectors(rows).astype('float32')
+        search_params = args.search_params or default_search_params(index_factory)
+        report = recall_report(index, embedding_reader, queries, args.recall_k, search_params)
+        with Path(output_dir, 'recall.json').open('w') as f:
+            json.dump(report, f, indent=2)
 
     logging.info('Done')
 
@@ -0,0 +1,132 @@
+import json
+import itertools
+import numpy as np
+from pathlib import Path
+from tqdm.auto import tqdm
+
+
+class NumpyReader:
+    """Lazy view over the shards of an embedding store.
+
+    Shards are memory-mapped and only read where they are accessed, and ids
+    are read from disk on first use. Rows tombstoned by update.py are hidden,
+    so row `i` is the i-th live row of the store.
+    """
+    def __init__(self, embedding_dir):
+        self.embedding_dir = embedding_dir
+        manifest_path = Path(embedding_dir, 'manifest.json')
+        tombstones = None
+        if manifest_path.exists():
+            # written by encode_parallel.py, lists the shards in order
+            with manifest_path.open('r') as f:
+                manifest = json.load(f)
+            shards = manifest['shards']
+            if manifest.get('tombstones'):
+                # rows replaced or removed by update.py
+                tombstones = np.load(Path(embedding_dir, manifest['tombstones']))
+            self.vec_files = [Path(embedding_dir, shard['embeddings']) for shard in shards]
+            self.id_files = [Path(embedding_dir, shard['ids']) for shard in shards]
+        else:
+            vec_files = list(Path(self.embedding_dir).glob('embeddings*.npy'))
+            self.vec_files = sorted(vec_files)
+            id_files = Path(embedding_dir).glob('ids*.txt')
+            self.id_files = sorted(id_files)
+
+        self.shards = [np.load(f, mmap_mode='r') for f in self.vec_files]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.dim = self.shards[0].shape[1]
+        self.dtype = self.shards[0].dtype
+        # global rows of the live rows, None when every row is live
+        self.live = None
+        if tombstones is not None and len(tombstones):
+            keep = np.ones(self.offsets[-1], dtype=bool)
+            keep[tombstones] = False
+            self.live = np.flatnonzero(keep)
+        self._ids = None
+        # ids as utf-8 bytes in sorted order and their rows, built on first lookup
+        self._sorted_ids = None
+        self._sorted_rows = None
+    
+    @property
+    def ids(self):
+        """all live ids, read on first use"""
+        if self._ids is None:
+            ids = []
+            for id_file in tqdm(self.id_files, total=len(self.id_files)):
+                with open(id_file, 'r') as f_id:
+                    ids.extend(l.strip('\n') for l in f_id)
+            if self.live is not None:
+                ids = [ids[row] for row in self.live]
+            self._ids = ids
+        return self._ids
+    
+    def get_vectors(self, rows):
+        """vectors of `rows`, gathered from the shards they live in"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.live is not None:
+            rows = self.live[rows]
+        vectors = np.empty((len(rows), self.dim), dtype=self.dtype)
+        shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            vectors[mask] = self.shards[shard_id][rows[mask] - self.offsets[shard_id]]
+        return vectors
+    
+    def __getitem__(self, row):
+        return {'id': self.ids[row], 'vector': self.get_vectors([row])[0]}
+    
+    def get_rows(self, ids, default=-1):
+        """rows of `ids`, `default` for ids that are not in the store"""
+        if self._sorted_ids is None:
+            all_ids = np.array([_id.encode('utf-8') for _id in self.ids], dtype=np.bytes_)
+            # stable, so the last row of a repeated id is the last of its run
+            self._sorted_rows = np.argsort(all_ids, kind='stable')
+            self._sorted_ids = all_ids[self._sorted_rows]
+        keys = np.array([_id.encode('utf-8') for _id in ids], dtype=np.bytes_)
+        rows = np.full(len(keys), default, dtype=np.int64)
+        if not len(keys) or not len(self._sorted_ids):
+            return rows
+        # keys in sorted order keep the binary searches close to each other in memory
+        order = np.argsort(keys)
+        pos = np.empty(len(keys), dtype=np.int64)
+        pos[order] = np.searchsorted(self._sorted_ids, keys[order], side='right') - 1
+        pos = np.maximum(pos, 0)
+        found = self._sorted_ids[pos] == keys
+        rows[found] = self._sorted_rows[pos[found]]
+        return rows
+    
+    def get_by_id(self, _id):
+        row, = self.get_rows([_id])
+        if row < 0:
+            raise KeyError(_id)
+        return self[row]
+    
+    def iter_blocks(self, block_size=65536, shard_ids=None):
+        """Yield `{'id': [...], 'vector': array}` blocks read straight from the shard files.
+
+        Only one block is in memory at a time. `shard_ids` restricts the
+        blocks to some of the shards.
+        """
+        for shard_id, (vectors, id_file) in enumerate(zip(self.shards, self.id_files)):
+            if shard_ids is not None and shard_id not in shard_ids:
+                continue
+            offset = self.offsets[shard_id]
+            with open(id_file, 'r') as f_id:
+                for start in range(0, len(vectors), block_size):
+                    block = np.asarray(vectors[start:start + block_size])
+                    ids = [l.strip('\n') for l in itertools.islice(f_id, len(block))]
+                    if self.live is not None:
+                        lo, hi = np.searchsorted(self.live, [offset + start, offset + start + len(block)])
+                        if hi - lo < len(block):
+                            keep = self.live[lo:hi] - offset - start
+                            block = block[keep]
+                            ids = [ids[i] for i in keep]
+                    yield {'id': ids, 'vector': block}
+    
+    def __iter__(self):
+        for block in self.iter_blocks():
+            for _id, vec in zip(block['id'], block['vector']):
+                yield {'id': _id, 'vector': vec}
+    
+    def __len__(self):
+        return int(self.offsets[-1]) if self.live is None else len(self.live)
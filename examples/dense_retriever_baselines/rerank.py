@@ -0,0 +1,112 @@
+import argparse
+import itertools
+import numpy as np
+from pathlib import Path
+from pyserini.output_writer import OutputFormat, get_output_writer, tie_breaker
+from tqdm.auto import tqdm
+
+from readers import NumpyReader
+from searchers import to_results
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Re-rank the candidates of a run with stored embeddings')
+    parser.add_argument('--run', type=str, help='TREC run to re-rank, e.g. from run_bm25_baseline.py')
+    parser.add_argument('--topics', type=str, help='embedding directory of the topics')
+    parser.add_argument('--embedding_dir', type=str, help='embedding directory of the documents')
+    parser.add_argument('--hits', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=64, help='topics scored together')
+    parser.add_argument('--output', type=str, default=None, help='default: the run name with a .clip-rerank suffix')
+    parser.add_argument('--output_format', type=str, default=OutputFormat.TREC.value)
+    parser.add_argument('--output_tag', type=str, default='clip-rerank')
+    return parser
+
+
+def read_run(path):
+    """yield (topic_id, docids) for each topic of a run, reading one topic at a time"""
+    seen = set()
+    with open(path, 'r') as f:
+        for topic_id, lines in itertools.groupby(f, key=lambda line: line.split(maxsplit=1)[0]):
+            if topic_id in seen:
+                raise ValueError(f'{path}: the lines of topic {topic_id} are not contiguous')
+            seen.add(topic_id)
+            yield topic_id, [line.split()[2] for line in lines]
+
+
+def score_batch(topics, docs, batch):
+    """return the candidates and scores of each topic of `batch`, and the number of missing topics and candidates"""
+    topic_rows = topics.get_rows([topic_id for topic_id, _ in batch])
+    batch = [(topic_id, docids) for (topic_id, docids), row in zip(batch, topic_rows) if row >= 0]
+    missing_topics = int((topic_rows < 0).sum())
+    topic_rows = topic_rows[topic_rows >= 0]
+
+    # every (topic, candidate) pair of the batch, flattened
+    doc_rows = [docs.get_rows(docids) for _, docids in batch]
+    missing_docs = sum(int((rows < 0).sum()) for rows in doc_rows)
+    doc_rows = [rows[rows >= 0] for rows in doc_rows]
+    counts = [len(rows) for rows in doc_rows]
+    pair_topics = np.repeat(np.arange(len(batch)), counts)
+    pair_docs = np.concatenate(doc_rows) if doc_rows else np.zeros(0, dtype=np.int64)
+
+    # candidates shared by topics are read once, in row order
+    unique_rows, pair_unique = np.unique(pair_docs, return_inverse=True)
+    doc_vectors = np.asarray(docs.get_vectors(unique_rows), dtype=np.float32)
+    topic_vectors = np.asarray(topics.get_vectors(topic_rows), dtype=np.float32)
+    pair_scores = np.einsum('pd,pd->p', doc_vectors[pair_unique], topic_vectors[pair_topics])
+
+    results = list(zip([topic_id for topic_id, _ in batch], doc_rows, np.split(pair_scores, np.cumsum(counts)[:-1])))
+    return results, missing_topics, missing_docs
+
+
+def main(args):
+    logging.info(f"{args}")
+    topics = NumpyReader(args.topics)
+    docs = NumpyReader(args.embedding_dir)
+
+    output_path = args.output
+    if output_path is None:
+        run_path = Path(args.run)
+        output_path = str(run_path.with_name(f'{run_path.stem}.clip-rerank{run_path.suffix}'))
+    logging.info('Re-ranking %s, saving to %s', args.run, output_path)
+
+    output_writer = get_output_writer(
+        output_path, OutputFormat(args.output_format), 'w',
+        max_hits=args.hits, tag=args.output_tag
+    )
+
+    num_topics, num_pairs, missing_topics, missing_docs = 0, 0, 0, 0
+    run = read_run(args.run)
+    with output_writer, tqdm(desc='rerank') as progress:
+        while True:
+            batch = list(itertools.islice(run, args.batch_size))
+            if not batch:
+                break
+            results, batch_missing_topics, batch_missing_docs = score_batch(topics, docs, batch)
+            for topic_id, rows, scores in results:
+                output_writer.write(topic_id, tie_breaker(to_results(docs.ids, scores, rows)))
+                num_pairs += len(rows)
+            num_topics += len(results)
+            missing_topics += batch_missing_topics
+            missing_docs += batch_missing_docs
+            progress.update(len(batch))
+
+    if missing_topics or missing_docs:
+        logging.warning('%d topics and %d candidates have no embedding and were dropped', missing_topics, missing_docs)
+    logging.info(
+        'Scored %d pairs for %d topics, %.4f%% of scoring every document',
+        num_pairs, num_topics, 100 * num_pairs / max(num_topics * len(docs), 1),
+    )
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -1,23 +1,28 @@
+import queue
 import argparse
-import numpy as np
-from pathlib import Path
-from pyserini.search.faiss import FaissSearcher
+import threading
 from pyserini.output_writer import OutputFormat, get_output_writer, tie_breaker
 from tqdm.auto import tqdm
 
-from index import NumpyReader
+from readers import NumpyReader
+from searchers import open_searcher, to_results
 
 
 
 def get_args_parser():
     parser = argparse.ArgumentParser('Evaluation', add_help=False)
     # Model settings
-    parser.add_argument('--index', type=str)
+    parser.add_argument('--index', type=str, help='faiss index directory, or with --exact an embedding directory')
+    parser.add_argument('--exact', action='store_true', help='brute-force search over the embeddings in --index, no faiss index needed')
+    parser.add_argument('--tile-size', type=int, default=16384, help='documents scored per GEMM with --exact')
     parser.add_argument('--topics', type=str)
-    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
+    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="unused, topics are precomputed embeddings")
     parser.add_argument('--hits', type=int, default=100)
-    parser.add_argument('--batch-size', type=int, default=64)
-    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=1024, help='topics per faiss search call')
+    parser.add_argument('--threads', type=int, default=32, help='faiss OpenMP threads')
+    parser.add_argument('--prefetch', type=int, default=4, help='searched batches queued for the writer thread')
+    parser.add_argument('--nprobe', type=int, default=None, help='IVF lists to visit, see recall.json of the index')
+    parser.add_argument('--ef-search', type=int, default=None, help='HNSW search beam width')
     parser.add_argument('--output', type=str, metavar='path')
     parser.add_argument('--output-format', type=str, metavar='format', default=OutputFormat.TREC.value)
     parser.add_argument('--output_tag', type=str, default='atomic')
@@ -25,11 +30,33 @@ def get_args_parser():
 
 
 
+def write_results(results, output_writer, searcher, progress, errors):
+    """writer thread, turns searched batches into runs while the next batch is searched"""
+    while True:
+        item = results.get()
+        if item is None:
+            return
+        if errors:
+            # keep draining so the search loop never blocks on a full queue
+            continue
+        try:
+            topic_ids, scores, labels = item
+            for topic_id, topic_scores, topic_labels in zip(topic_ids, scores, labels):
+                output_writer.write(topic_id, tie_breaker(to_results(searcher.docids, topic_scores, topic_labels)))
+            progress.update(len(topic_ids))
+        except BaseException as e:
+            errors.append(e)
+
+
 def main(args):
-    searcher = FaissSearcher(
-        index_dir=args.index,
-        query_encoder=args.encoder,
-    )
+    searcher = open_searcher(args.index, args.exact, args.tile_size, args.threads)
+    search_params = []
+    if args.nprobe is not None:
+        search_params.append(f'nprobe={args.nprobe}')
+    if args.ef_search is not None:
+        search_params.append(f'efSearch={args.ef_search}')
+    if search_params and not args.exact:
+        searcher.set_search_params(','.join(search_params))
     topics = NumpyReader(args.topics)
 
     output_path = args.output
@@ -46,34 +73,24 @@ def main(args):
     )
 
     with output_writer:
-        batch_topics = list()
-        batch_topic_ids = list()
-        for index, item in enumerate(tqdm(topics, total=len(topics))):
-            topic_id = item['id']
-            topic_vec = item['vector']
-            
-            batch_topic_ids.append(str(topic_id))
-            batch_topics.append(topic_vec.reshape(1, -1))
-            if (index + 1) % args.batch_size == 0 or index == len(topic_vec) - 1:
-                
-                results = searcher.batch_search(
-                    queries=np.concatenate(batch_topics),
-                    q_ids=batch_topic_ids,
-                    k=args.hits,
-                    threads=args.threads,
-                    return_vector=False
-                )
-                
-                results = [(id_, results[id_]) for id_ in batch_topic_ids]
-                batch_topic_ids.clear()
-                batch_topics.clear()
-            else:
-                continue
-        
-            for topic, hits in results:
-                output_writer.write(topic, tie_breaker(hits))
-            
-            results.clear()
+        progress = tqdm(total=len(topics))
+        results, errors = queue.Queue(maxsize=args.prefetch), []
+        writer = threading.Thread(target=write_results, args=(results, output_writer, searcher, progress, errors), daemon=True)
+        writer.start()
+        try:
+            # topics are read from the memory-mapped shards one batch at a time,
+            # the last batch holds whatever is left
+            for block in topics.iter_blocks(args.batch_size):
+                if errors:
+                    break
+                scores, labels = searcher.search_arrays(block['vector'], k=args.hits, threads=args.threads)
+                results.put(([str(topic_id) for topic_id in block['id']], scores, labels))
+        finally:
+            results.put(None)
+            writer.join()
+        progress.close()
+        if errors:
+            raise errors[0]
 
 
 
@@ -0,0 +1,127 @@
+import json
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from readers import NumpyReader
+from exact_search import ExactSearcher
+
+
+def to_results(docids, scores, labels):
+    """`DenseSearchResult`s of one query, skipping the -1 labels of missing hits"""
+    from pyserini.search.faiss import DenseSearchResult
+
+    return [DenseSearchResult(docids[label], float(score)) for score, label in zip(scores, labels) if label >= 0]
+
+
+def read_docids(index_dir):
+    with Path(index_dir, 'docid').open('r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+class IndexSearcher:
+    """Search a faiss index directory with precomputed query vectors.
+
+    Unlike `pyserini.search.faiss.FaissSearcher` it loads no query encoder.
+    `search_arrays` returns raw scores and labels into `self.docids`;
+    `batch_search` and `search` return `DenseSearchResult`s like pyserini.
+    """
+    def __init__(self, index_dir):
+        import faiss
+
+        self.index = faiss.read_index(str(Path(index_dir, 'index')))
+        self.docids = read_docids(index_dir)
+        self.dimension = self.index.d
+        self.num_docs = self.index.ntotal
+
+    def set_search_params(self, params):
+        """faiss search parameters such as `nprobe=16`"""
+        import faiss
+
+        faiss.ParameterSpace().set_index_parameters(self.index, params)
+
+    def search_arrays(self, queries, k=10, threads=None):
+        import faiss
+
+        if threads:
+            faiss.omp_set_num_threads(threads)
+        return self.index.search(np.ascontiguousarray(queries, dtype='float32'), k)
+
+    def batch_search(self, queries, q_ids, k=10, threads=None, return_vector=False):
+        """return {q_id: [DenseSearchResult]} for a (n, dim) array of query vectors"""
+        scores, labels = self.search_arrays(queries, k, threads)
+        return {q_id: to_results(self.docids, scores[row], labels[row]) for row, q_id in enumerate(q_ids)}
+
+    def search(self, query, k=10, threads=None, return_vector=False):
+        return self.batch_search(np.asarray(query).reshape((1, -1)), ['q'], k, threads)['q']
+
+
+class ShardedSearcher(IndexSearcher):
+    """Search the sub-indexes written by `index.py --sharded` as one index.
+
+    Every batch of queries is searched on all sub-indexes concurrently in a
+    thread pool (faiss releases the GIL while searching), and the per-query
+    top-k of the sub-indexes are merged with `faiss.merge_knn_results`.
+    Labels are offset by the sub-index they come from, so they index the
+    concatenated docids.
+    """
+    def __init__(self, index_dir, threads=None):
+        import faiss
+
+        with Path(index_dir, 'shards.json').open('r') as f:
+            shard_dirs = json.load(f)['shards']
+        self.indexes, self.docids, self.offsets = [], [], []
+        for shard_dir in shard_dirs:
+            self.offsets.append(len(self.docids))
+            self.indexes.append(faiss.read_index(str(Path(index_dir, shard_dir, 'index'))))
+            self.docids.extend(read_docids(Path(index_dir, shard_dir)))
+        self.dimension = self.indexes[0].d
+        self.num_docs = len(self.docids)
+        self.pool = ThreadPoolExecutor(min(threads or len(self.indexes), len(self.indexes)))
+
+    def set_search_params(self, params):
+        import faiss
+
+        parameter_space = faiss.ParameterSpace()
+        for index in self.indexes:
+            parameter_space.set_index_parameters(index, params)
+
+    @staticmethod
+    def search_shard(index, queries, k, threads):
+        """pool task, OpenMP thread counts are per calling thread so the task sets its own"""
+        import faiss
+
+        if threads:
+            faiss.omp_set_num_threads(threads)
+        return index.search(queries, k)
+
+    def search_arrays(self, queries, k=10, threads=None):
+        import faiss
+
+        queries = np.ascontiguousarray(queries, dtype='float32')
+        # split the cores between the sub-indexes searched at once
+        shard_threads = max(1, threads // len(self.indexes)) if threads else None
+        futures = [self.pool.submit(self.search_shard, index, queries, k, shard_threads) for index in self.indexes]
+        shard_results = [future.result() for future in futures]
+
+        # one C heap merge over all queries, missing results keep label -1
+        all_scores = np.stack([shard_scores for shard_scores, _ in shard_results])
+        all_labels = np.stack([
+            np.where(shard_labels >= 0, shard_labels + offset, -1)
+            for offset, (_, shard_labels) in zip(self.offsets, shard_results)
+        ])
+        return faiss.merge_knn_results(all_scores, all_labels, keep_max=True)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def open_searcher(index_dir, exact=False, tile_size=16384, threads=None):
+    """the searcher for a faiss index directory, a sharded one, or with `exact` an embedding directory"""
+    # faiss and pyserini are imported where they are used, `exact` needs only NumPy
+    if exact:
+        return ExactSearcher(NumpyReader(index_dir), tile_size=tile_size, threads=threads)
+    if Path(index_dir, 'shards.json').exists():
+        # written by index.py --sharded
+        return ShardedSearcher(index_dir, threads=threads)
+    return IndexSearcher(index_dir)
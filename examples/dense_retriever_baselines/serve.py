@@ -0,0 +1,263 @@
+import time
+import base64
+import asyncio
+import argparse
+import torch
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from PIL import Image
+
+from encoders import BACKENDS, ClipEncoder
+from encode import ImageCollator, TextCollator
+from searchers import open_searcher
+from src.data import AtomicDataset
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Serve suggestions for raw text or image queries over HTTP')
+    parser.add_argument('--index', type=str, help='faiss index directory, or with --exact an embedding directory')
+    parser.add_argument('--exact', action='store_true', help='brute-force search over the embeddings in --index')
+    parser.add_argument('--tile_size', type=int, default=16384)
+    parser.add_argument('--nprobe', type=int, default=None)
+    parser.add_argument('--ef_search', type=int, default=None)
+    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--backend', type=str, default='eager', choices=BACKENDS)
+    parser.add_argument('--onnx_dir', type=str, default='onnx')
+    parser.add_argument('--threads', type=int, default=None, help='torch and faiss threads')
+    parser.add_argument('--hits', type=int, default=10, help='default hits per query, a request can ask for up to --max_hits')
+    parser.add_argument('--max_hits', type=int, default=1000)
+    parser.add_argument('--max_batch_size', type=int, default=32, help='queries encoded and searched together')
+    parser.add_argument('--max_wait_ms', type=float, default=5, help='how long the first query of a batch waits for more')
+    parser.add_argument('--metadata', type=str, default=None, help='collection of the indexed documents, e.g. TREC-AToMiC/AToMiC-Images-v0.2')
+    parser.add_argument('--id_column', type=str, default='image_id', help='id column of --metadata')
+    parser.add_argument('--metadata_columns', type=str, default=None, help='comma separated columns returned with each hit, default: all but the image')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    return parser
+
+
+class MicroBatcher:
+    """Collect concurrent queries into batches for a blocking `process` function.
+
+    A batch is flushed when it holds `max_batch_size` queries, or `max_wait`
+    seconds after its first query arrived. `process` maps a list of queries
+    to a list of results and runs in `executor`, so the event loop keeps
+    accepting queries while a batch is encoded and searched. When a batch
+    fails, its queries are retried one by one, so only the failing query
+    gets the error.
+    """
+    def __init__(self, process, executor, max_batch_size=32, max_wait=0.005):
+        self.process = process
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.full = asyncio.Event()
+        self.batches = 0
+        self.queries = 0
+
+    async def submit(self, query):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((query, future, loop.time()))
+        self.arrived.set()
+        if len(self.pending) >= self.max_batch_size:
+            self.full.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.arrived.wait()
+            timeout = self.pending[0][2] + self.max_wait - loop.time()
+            if len(self.pending) < self.max_batch_size and timeout > 0:
+                # waiting on an event, unlike on a queue, never loses a query on timeout
+                try:
+                    await asyncio.wait_for(self.full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            if not self.pending:
+                self.arrived.clear()
+            if len(self.pending) < self.max_batch_size:
+                self.full.clear()
+            # clients that gave up are not worth encoding
+            batch = [(query, future) for query, future, _ in batch if not future.cancelled()]
+            if not batch:
+                continue
+
+            self.batches += 1
+            self.queries += len(batch)
+            await self.process_batch(batch)
+
+    async def process_batch(self, batch):
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.process, [query for query, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # find the failing query, the others still get their results
+                for item in batch:
+                    await self.process_batch([item])
+                return
+            (_, future), = batch
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class Suggester:
+    """Encode raw queries with `ClipEncoder` and search them, a batch at a time"""
+    def __init__(self, encoder, searcher, metadata=None, metadata_columns=None, threads=None):
+        self.encoder = encoder
+        self.searcher = searcher
+        self.threads = threads
+        self.collators = {
+            'text': TextCollator('id', 'text', encoder.processor.tokenizer),
+            'image': ImageCollator('id', 'image', encoder.processor.image_processor),
+        }
+        self.metadata = metadata
+        self.metadata_columns = metadata_columns
+
+    def __call__(self, queries, encode_type):
+        """return the hits of each query, `queries` are dicts with `encode_type` content and `k`"""
+        items = [{'id': row, encode_type: query[encode_type]} for row, query in enumerate(queries)]
+        inputs = self.collators[encode_type](items)
+        vectors = self.encoder.encode(inputs, encode_type=encode_type)
+
+        k = max(query['k'] for query in queries)
+        scores, labels = self.searcher.search_arrays(vectors, k=k, threads=self.threads)
+        results = [
+            [{'id': self.searcher.docids[label], 'score': float(score)} for score, label in zip(scores[row, :query['k']], labels[row, :query['k']]) if label >= 0]
+            for row, query in enumerate(queries)
+        ]
+
+        if self.metadata is not None:
+            # one Arrow take for the hits of the whole batch
+            hits = [hit for hits in results for hit in hits]
+            batch = self.metadata.get_many([hit['id'] for hit in hits], columns=self.metadata_columns)
+            for row, hit in enumerate(hits):
+                hit.update((column, values[row]) for column, values in batch.items() if column != self.metadata.id_column)
+        return results
+
+
+def decode_image(data):
+    """an RGB image from the bytes of an upload, `ValueError` if it cannot be read"""
+    try:
+        image = Image.open(BytesIO(data))
+        # grayscale, palette and RGBA uploads would reach the model with the wrong channels
+        return image.convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f'cannot read the image: {e}')
+
+
+def parse_query(body, default_k, max_k):
+    """the query of a request body `{"text": ...}` or `{"image": <base64>}`, with an optional `k`"""
+    k = int(body.get('k', default_k))
+    if not 0 < k <= max_k:
+        raise ValueError(f'k must be between 1 and {max_k}')
+    if isinstance(body.get('text'), str):
+        return 'text', {'text': body['text'], 'k': k}
+    if isinstance(body.get('image'), str):
+        # decoded per request, so a bad upload fails alone instead of its whole batch
+        return 'image', {'image': decode_image(base64.b64decode(body['image'])), 'k': k}
+    raise ValueError('give a "text" or a base64 encoded "image"')
+
+
+def make_app(suggester, args):
+    executor = ThreadPoolExecutor(1)  # one batch on the model at a time
+    batchers = {}
+
+    async def start(app):
+        for encode_type in ['text', 'image']:
+            process = lambda queries, encode_type=encode_type: suggester(queries, encode_type)
+            batchers[encode_type] = MicroBatcher(process, executor, args.max_batch_size, args.max_wait_ms / 1000)
+        app['tasks'] = [asyncio.ensure_future(batcher.run()) for batcher in batchers.values()]
+
+    async def stop(app):
+        for task in app['tasks']:
+            task.cancel()
+        executor.shutdown()
+
+    async def search(request):
+        start_time = time.perf_counter()
+        try:
+            encode_type, query = parse_query(await request.json(), args.hits, args.max_hits)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        hits = await batchers[encode_type].submit(query)
+        return web.json_response({'hits': hits, 'took_ms': 1000 * (time.perf_counter() - start_time)})
+
+    async def stats(request):
+        return web.json_response({
+            encode_type: {
+                'queries': batcher.queries,
+                'batches': batcher.batches,
+                'mean_batch_size': batcher.queries / max(batcher.batches, 1),
+            }
+            for encode_type, batcher in batchers.items()
+        })
+
+    app = web.Application()
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    app.router.add_post('/search', search)
+    app.router.add_get('/stats', stats)
+    return app
+
+
+def main(args):
+    logging.info(f"{args}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    encoder = ClipEncoder(
+        args.encoder,
+        device=args.device,
+        dtype=args.dtype,
+        l2_norm=True,
+        backend=args.backend,
+        onnx_dir=args.onnx_dir,
+    )
+    searcher = open_searcher(args.index, args.exact, args.tile_size, args.threads)
+    search_params = []
+    if args.nprobe is not None:
+        search_params.append(f'nprobe={args.nprobe}')
+    if args.ef_search is not None:
+        search_params.append(f'efSearch={args.ef_search}')
+    if search_params and not args.exact:
+        searcher.set_search_params(','.join(search_params))
+    logging.info('Loaded %d documents of dimension %d', searcher.num_docs, searcher.dimension)
+
+    metadata, metadata_columns = None, None
+    if args.metadata:
+        metadata = AtomicDataset(data_name_or_path=args.metadata, id_column=args.id_column)
+        if args.metadata_columns:
+            metadata_columns = args.metadata_columns.split(',')
+        else:
+            metadata_columns = [column for column in metadata.column_names if column != 'image']
+
+    suggester = Suggester(encoder, searcher, metadata, metadata_columns, args.threads)
+    web.run_app(make_app(suggester, args), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,48 @@
+import sys
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# the scripts import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+
+
+@pytest.fixture
+def vectors():
+    """64 unit vectors, row i is document `doc-i`"""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((64, 16)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def write_store(embedding_dir, ids, vectors):
+    """an embedding store like the one encode.py writes, in one shard"""
+    embedding_dir.mkdir(parents=True, exist_ok=True)
+    np.save(embedding_dir / 'embeddings.0-of-1.npy', vectors.astype(np.float16))
+    (embedding_dir / 'ids.0-of-1.txt').write_text(''.join(f'{_id}\n' for _id in ids))
+    return embedding_dir
+
+
+def write_flat_index(index_dir, ids, vectors):
+    """a flat inner product index directory like the one index.py writes"""
+    import faiss
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    index = faiss.IndexFlatIP(vectors.shape[1])
+    index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    faiss.write_index(index, str(index_dir / 'index'))
+    (index_dir / 'docid').write_text(''.join(f'{_id}\n' for _id in ids))
+    return index_dir
+
+
+def write_sharded_index(index_dir, ids, vectors, num_shards):
+    """sub-index directories and shards.json like the ones index.py --sharded writes"""
+    index_dir.mkdir(parents=True, exist_ok=True)
+    shard_dirs = [f'shard-{shard_id:04d}' for shard_id in range(num_shards)]
+    bounds = np.linspace(0, len(ids), num_shards + 1).astype(int)
+    for shard_dir, start, end in zip(shard_dirs, bounds[:-1], bounds[1:]):
+        write_flat_index(index_dir / shard_dir, ids[start:end], vectors[start:end])
+    (index_dir / 'shards.json').write_text(json.dumps({'shards': shard_dirs}))
+    return index_dir
@@ -0,0 +1,22 @@
+import sys
+
+import numpy as np
+
+from conftest import write_store
+from searchers import open_searcher
+
+
+def test_exact_search_without_faiss(tmp_path, monkeypatch, vectors):
+    # importing faiss fails from here on
+    monkeypatch.setitem(sys.modules, 'faiss', None)
+    store = write_store(tmp_path / 'docs', [f'doc-{row}' for row in range(len(vectors))], vectors)
+
+    searcher = open_searcher(str(store), exact=True, tile_size=10, threads=2)
+    scores, labels = searcher.search_arrays(vectors[:4], k=3)
+    searcher.close()
+
+    stored = vectors.astype(np.float16).astype(np.float32)
+    expected = np.argsort(-(vectors[:4] @ stored.T), axis=1, kind='stable')[:, :3]
+    assert (labels == expected).all()
+    assert np.allclose(scores[:, 0], 1.0, atol=1e-3)
+    assert [searcher.docids[label] for label in labels[:, 0]] == ['doc-0', 'doc-1', 'doc-2', 'doc-3']
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pyserini')
+
+from conftest import write_store
+from rerank import get_args_parser, main
+
+
+def test_rerank_toy_run(tmp_path, vectors):
+    vectors = vectors.astype(np.float16).astype(np.float32)
+    ids = [f'doc-{row}' for row in range(len(vectors))]
+    docs = write_store(tmp_path / 'docs', ids, vectors)
+    topics = write_store(tmp_path / 'topics', ['q-0', 'q-1'], vectors[:2])
+
+    # BM25-like candidates in arbitrary order, with one unknown document
+    candidates = {'q-0': [5, 0, 9, 3], 'q-1': [1, 7, 2]}
+    run = tmp_path / 'run.bm25.trec'
+    with run.open('w') as f:
+        for topic_id, rows in candidates.items():
+            for rank, row in enumerate(rows, start=1):
+                f.write(f'{topic_id} Q0 doc-{row} {rank} {10 - rank} Anserini\n')
+        f.write('q-1 Q0 unknown 4 1 Anserini\n')
+
+    output = tmp_path / 'run.rerank.trec'
+    main(get_args_parser().parse_args(['--run', str(run), '--topics', str(topics), '--embedding_dir', str(docs), '--output', str(output)]))
+
+    reranked = {}
+    with output.open('r') as f:
+        for line in f:
+            topic_id, _, docid, _, score, _ = line.split()
+            reranked.setdefault(topic_id, []).append((docid, float(score)))
+    for topic_row, (topic_id, rows) in enumerate(candidates.items()):
+        scores = vectors[rows] @ vectors[topic_row]
+        expected = [f'doc-{rows[i]}' for i in np.argsort(-scores, kind='stable')]
+        assert [docid for docid, _ in reranked[topic_id]] == expected
+        assert [score for _, score in reranked[topic_id]] == pytest.approx(sorted(scores, reverse=True), abs=1e-5)
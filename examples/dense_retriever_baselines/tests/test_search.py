@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+pytest.importorskip('pyserini')
+
+from conftest import write_flat_index, write_store
+from search import get_args_parser, main
+
+
+def read_run(path):
+    run = {}
+    with open(path, 'r') as f:
+        for line in f:
+            topic_id, _, docid, rank, score, _ = line.split()
+            run.setdefault(topic_id, []).append((docid, int(rank), float(score)))
+    return run
+
+
+@pytest.mark.parametrize('exact', [False, True])
+def test_search_writes_trec_run(tmp_path, vectors, exact):
+    # the store keeps fp16, index the same values so both modes see one collection
+    vectors = vectors.astype(np.float16).astype(np.float32)
+    ids = [f'doc-{row}' for row in range(len(vectors))]
+    store = write_store(tmp_path / 'docs', ids, vectors)
+    topics = write_store(tmp_path / 'topics', [f'q-{row}' for row in range(10)], vectors[:10])
+    index = store if exact else write_flat_index(tmp_path / 'index', ids, vectors)
+
+    output = tmp_path / 'run.trec'
+    argv = ['--index', str(index), '--topics', str(topics), '--hits', '5', '--batch-size', '4', '--threads', '1', '--output', str(output)]
+    main(get_args_parser().parse_args(argv + (['--exact', '--tile-size', '16'] if exact else [])))
+
+    run = read_run(output)
+    assert sorted(run) == sorted(f'q-{row}' for row in range(10))
+    for row in range(10):
+        hits = run[f'q-{row}']
+        assert [rank for _, rank, _ in hits] == [1, 2, 3, 4, 5]
+        expected = np.argsort(-(vectors @ vectors[row]), kind='stable')[:5]
+        assert [docid for docid, _, _ in hits] == [f'doc-{i}' for i in expected]
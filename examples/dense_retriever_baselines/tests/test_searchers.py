@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('faiss')
+
+from conftest import write_flat_index, write_sharded_index
+from searchers import IndexSearcher, ShardedSearcher
+
+
+def test_batch_search_flat_index(tmp_path, vectors):
+    pytest.importorskip('pyserini')
+    ids = [f'doc-{row}' for row in range(len(vectors))]
+    searcher = IndexSearcher(write_flat_index(tmp_path / 'index', ids, vectors))
+
+    results = searcher.batch_search(vectors[:3], ['q0', 'q1', 'q2'], k=5)
+
+    assert list(results) == ['q0', 'q1', 'q2']
+    for row, q_id in enumerate(results):
+        hits = results[q_id]
+        assert len(hits) == 5
+        # every document is its own nearest neighbour
+        assert hits[0].docid == f'doc-{row}'
+        assert hits[0].score == pytest.approx(1.0, abs=1e-5)
+        assert [hit.score for hit in hits] == sorted((hit.score for hit in hits), reverse=True)
+    assert searcher.search(vectors[7], k=1)[0].docid == 'doc-7'
+
+
+def test_sharded_search_matches_flat(tmp_path, vectors):
+    faiss = pytest.importorskip('faiss')
+    ids = [f'doc-{row}' for row in range(len(vectors))]
+    flat = IndexSearcher(write_flat_index(tmp_path / 'flat', ids, vectors))
+    sharded = ShardedSearcher(write_sharded_index(tmp_path / 'sharded', ids, vectors, num_shards=2), threads=2)
+
+    caller_threads = faiss.omp_get_max_threads()
+    scores, labels = sharded.search_arrays(vectors[:8], k=5, threads=8)
+    flat_scores, flat_labels = flat.search_arrays(vectors[:8], k=5)
+    assert (labels == flat_labels).all()
+    assert np.allclose(scores, flat_scores, atol=1e-6)
+
+    # the thread count is set in the pool thread that searches, not in the caller
+    assert faiss.omp_get_max_threads() == caller_threads
+    def shard_task():
+        sharded.search_shard(sharded.indexes[0], vectors[:1], 1, 4)
+        return faiss.omp_get_max_threads()
+    assert sharded.pool.submit(shard_task).result() == 4
+    sharded.close()
+
+
+def test_sharded_search_pads_missing_hits(tmp_path, vectors):
+    ids = [f'doc-{row}' for row in range(len(vectors))]
+    sharded = ShardedSearcher(write_sharded_index(tmp_path / 'sharded', ids[:20], vectors[:20], num_shards=2))
+
+    # more hits than documents, both shards pad with -1
+    scores, labels = sharded.search_arrays(vectors[:3], k=25)
+    assert labels.shape == (3, 25)
+    assert (labels[:, 20:] == -1).all()
+    assert sorted(labels[0, :20].tolist()) == list(range(20))
+    assert labels[0, 0] == 0
+    assert (np.diff(scores[:, :20], axis=1) <= 0).all()
+    sharded.close()
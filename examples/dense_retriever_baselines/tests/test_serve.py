@@ -0,0 +1,53 @@
+import io
+import base64
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+pytest.importorskip('aiohttp')
+
+from serve import MicroBatcher, parse_query
+
+
+def png(mode, color):
+    buffer = io.BytesIO()
+    Image.new(mode, (8, 6), color).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+@pytest.mark.parametrize('mode,color', [('RGB', (200, 10, 10)), ('RGBA', (0, 200, 0, 128)), ('L', 100), ('P', 3)])
+def test_parse_query_converts_images_to_rgb(mode, color):
+    encode_type, query = parse_query({'image': png(mode, color), 'k': 3}, 10, 100)
+    assert encode_type == 'image'
+    assert query['image'].mode == 'RGB'
+    assert query['k'] == 3
+
+
+def test_parse_query_rejects_unreadable_images():
+    with pytest.raises(ValueError):
+        parse_query({'image': base64.b64encode(b'junk').decode('ascii')}, 10, 100)
+
+
+def test_failing_query_does_not_fail_its_batch():
+    calls = []
+
+    def process(queries):
+        calls.append(len(queries))
+        if 'bad' in queries:
+            raise RuntimeError('bad query')
+        return [query.upper() for query in queries]
+
+    async def run():
+        batcher = MicroBatcher(process, ThreadPoolExecutor(1), max_batch_size=3, max_wait=1)
+        task = asyncio.ensure_future(batcher.run())
+        results = await asyncio.gather(*[batcher.submit(query) for query in ['a', 'bad', 'b']], return_exceptions=True)
+        task.cancel()
+        return results
+
+    a, bad, b = asyncio.run(run())
+    assert (a, b) == ('A', 'B')
+    assert isinstance(bad, RuntimeError)
+    # the batch, then each query alone
+    assert calls == [3, 1, 1, 1]
@@ -0,0 +1,270 @@
+import os
+import json
+import argparse
+import faiss
+import numpy as np
+from pathlib import Path
+from torch.utils.data import DataLoader
+from datasets import Image as ImageFeature
+from tqdm.auto import tqdm
+
+from encoders import BACKENDS, ClipEncoder
+from embedding_cache import CachedEncoder, EmbeddingCache, content_hash, image_hash
+from encode import (
+    FastImageCollator, ImageCollator, NumpyWriter, StageTimer, TextCollator,
+    IMAGE_FIELD, TEXT_FIELDS, encode_batches,
+)
+from encode_parallel import MANIFEST, write_manifest
+from index import add_vectors
+from src.data import AtomicDataset
+
+import logging
+
+# Configure the logger
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+# versioned per update, only the manifest that commits an update points at its files
+TOMBSTONES = 'tombstones.{:03d}.npy'
+HASHES = 'content_hashes.{:03d}.tsv'
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Patch an embedding store and its index to a new collection version')
+    parser.add_argument('--old_inputs', type=str, default=None, help='version the store was encoded from, only needed when the store has no content hashes yet')
+    parser.add_argument('--inputs', type=str, default='TREC-AToMiC/AToMiC-Texts-v0.2.1', help='new version')
+    parser.add_argument('--encode_type', type=str, default='text', choices=['text', 'image'])
+    parser.add_argument('--id_column', type=str, default='text_id')
+    parser.add_argument('--split', type=str, default=None, help='split the store holds, default: the whole collection')
+    parser.add_argument('--qrels', type=str, default='TREC-AToMiC/AToMiC-Qrels-v0.2')
+    parser.add_argument('--embedding_dir', type=str, help='store written by encode.py or encode_parallel.py, patched in place')
+    parser.add_argument('--index', type=str, default=None, help='faiss index directory built from the store, patched in place')
+    parser.add_argument('--encoder', type=str, default='openai/clip-vit-base-patch32', help="encoder name")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--num_proc', type=int, default=None, help='processes for hashing the collections')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--backend', type=str, default='eager', choices=BACKENDS)
+    parser.add_argument('--onnx_dir', type=str, default='onnx')
+    parser.add_argument('--image_preprocess', type=str, default='torch', choices=['torch', 'pil'], help='must match the store')
+    parser.add_argument('--embedding_cache', type=str, default=None)
+    parser.add_argument('--dry_run', action='store_true', help='only report the diff')
+    return parser
+
+
+def read_manifest(embedding_dir):
+    """the manifest of a store, made up from the shard files if there is none"""
+    manifest_path = Path(embedding_dir, MANIFEST)
+    if manifest_path.exists():
+        with manifest_path.open('r') as f:
+            return json.load(f)
+
+    shards = []
+    for vec_file, id_file in zip(sorted(Path(embedding_dir).glob('embeddings*.npy')), sorted(Path(embedding_dir).glob('ids*.txt'))):
+        vectors = np.load(vec_file, mmap_mode='r')
+        shards.append({'embeddings': vec_file.name, 'ids': id_file.name, 'rows': len(vectors)})
+    if not shards:
+        raise FileNotFoundError(f'{embedding_dir} has no {MANIFEST} and no embedding shards')
+    return {'rows': sum(shard['rows'] for shard in shards), 'dim': vectors.shape[1], 'dtype': vectors.dtype.str, 'shards': shards}
+
+
+def read_live_ids(embedding_dir, manifest):
+    """ids of the store and their rows, without the tombstoned rows"""
+    ids = []
+    for shard in manifest['shards']:
+        with Path(embedding_dir, shard['ids']).open('r') as f:
+            ids.extend(line.rstrip('\n') for line in f)
+    dead = set()
+    if manifest.get('tombstones'):
+        dead = set(np.load(Path(embedding_dir, manifest['tombstones'])).tolist())
+    return {_id: row for row, _id in enumerate(ids) if row not in dead}
+
+
+def hash_rows(batch, encode_type, id_column):
+    items = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    if encode_type == 'text':
+        collator = TextCollator(id_column, TEXT_FIELDS, processor=None)
+        hashes = [content_hash(collator.get_text(item)) for item in items]
+    else:
+        hashes = [image_hash(item[IMAGE_FIELD]) for item in items]
+    return {'hash': hashes}
+
+
+def load_hashes(inputs, args, split=None):
+    """the collection, its ids and the content hash of every row"""
+    dataset = AtomicDataset(
+        data_name_or_path=inputs,
+        id_column=args.id_column,
+        qrel_name_or_path=args.qrels if split else None,
+    )
+    if split:
+        dataset = dataset.get_split(split)
+    if args.encode_type == 'image':
+        dataset = dataset.cast_column(IMAGE_FIELD, ImageFeature(decode=False))
+
+    # cached by datasets, hashing the same version twice is free
+    hashes = dataset.map(
+        hash_rows,
+        batched=True,
+        num_proc=args.num_proc,
+        fn_kwargs={'encode_type': args.encode_type, 'id_column': args.id_column},
+        remove_columns=[c for c in dataset.column_names if c != args.id_column],
+        desc=f'hash {inputs}',
+    )
+    return dataset, dict(zip(hashes[args.id_column], hashes['hash']))
+
+
+def encode_rows(dataset, rows, output_dir, args):
+    encoder = ClipEncoder(
+        args.encoder,
+        encode_type=args.encode_type,
+        device=args.device,
+        dtype=args.dtype,
+        l2_norm=True,
+        backend=args.backend,
+        onnx_dir=args.onnx_dir,
+    )
+    hash_content = args.embedding_cache is not None
+    if args.encode_type == 'text':
+        collator = TextCollator(args.id_column, TEXT_FIELDS, encoder.processor.tokenizer, hash_content=hash_content)
+    else:
+        collator_class = FastImageCollator if args.image_preprocess == 'pil' else ImageCollator
+        collator = collator_class(args.id_column, IMAGE_FIELD, encoder.processor.image_processor, hash_content=hash_content)
+    if hash_content:
+        namespace = f'{args.encoder}|{args.encode_type}|{args.dtype}|{args.backend}'
+        if args.encode_type == 'image':
+            namespace += f'|{args.image_preprocess}'
+        encoder = CachedEncoder(encoder, EmbeddingCache(args.embedding_cache, namespace))
+
+    iterator = DataLoader(
+        dataset.select(rows),
+        collate_fn=collator,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        shuffle=False,
+        drop_last=False,
+    )
+    writer = NumpyWriter(dir_path=output_dir, filename='embeddings', shard_id=0, shard_num=1, num_rows=len(rows))
+    with writer:
+        timer = StageTimer()
+        encode_batches(tqdm(iterator, desc='encode ...'), encoder, writer, timer)
+        writer.write()
+        timer.report()
+    return writer
+
+
+def patch_index(index_dir, dead_ids, vectors, ids, block_size=65536):
+    """Remove `dead_ids` from a faiss index and its docid file, then append `vectors`.
+
+    Both files are written to temp files and renamed into place. The two
+    renames are not atomic together, an index and docid file that disagree
+    are refused, rebuild the index with index.py then.
+    """
+    index = faiss.read_index(str(Path(index_dir, 'index')))
+    if not isinstance(index, faiss.IndexFlatCodes):
+        # other index types keep their labels on removal, the docid file would no longer line up
+        raise ValueError(f'{index_dir} is not a flat, fp16 or sq8 index, rebuild it with index.py')
+    with Path(index_dir, 'docid').open('r') as f:
+        docids = [line.rstrip('\n') for line in f]
+    if len(docids) != index.ntotal:
+        raise ValueError(f'{index_dir} has {index.ntotal} vectors but {len(docids)} docids, rebuild it with index.py')
+
+    positions = np.array([i for i, docid in enumerate(docids) if docid in dead_ids], dtype='int64')
+    if len(positions):
+        # flat code indexes compact on removal, positions after the removed ones shift down
+        index.remove_ids(positions)
+        removed = set(positions.tolist())
+        docids = [docid for i, docid in enumerate(docids) if i not in removed]
+    for start in range(0, len(vectors), block_size):
+        add_vectors(index, vectors[start:start + block_size])
+    docids.extend(ids)
+    logging.info('Index: %d removed, %d added, %d total', len(positions), len(ids), index.ntotal)
+
+    faiss.write_index(index, str(Path(index_dir, 'index.tmp')))
+    with Path(index_dir, 'docid.tmp').open('w') as f:
+        for docid in docids:
+            f.write(f'{docid}\n')
+    for name in ['index', 'docid']:
+        os.replace(Path(index_dir, f'{name}.tmp'), Path(index_dir, name))
+
+
+def main(args):
+    logging.info(f"{args}")
+    embedding_dir = Path(args.embedding_dir)
+    manifest = read_manifest(embedding_dir)
+    live = read_live_ids(embedding_dir, manifest)
+
+    if manifest.get('hashes'):
+        with Path(embedding_dir, manifest['hashes']).open('r') as f:
+            old_hashes = dict(line.rstrip('\n').split('\t') for line in f)
+    elif args.old_inputs:
+        _, old_hashes = load_hashes(args.old_inputs, args, args.split)
+    else:
+        raise ValueError(f'{embedding_dir} has no content hashes yet, give the version it was encoded from with --old_inputs')
+    old_hashes = {_id: old_hashes.get(_id) for _id in live}
+
+    dataset, new_hashes = load_hashes(args.inputs, args, args.split)
+    removed = [_id for _id in old_hashes if _id not in new_hashes]
+    changed = [_id for _id, _hash in new_hashes.items() if _id in old_hashes and old_hashes[_id] != _hash]
+    added = [_id for _id in new_hashes if _id not in old_hashes]
+    logging.info('%d added, %d changed, %d removed, %d unchanged', len(added), len(changed), len(removed), len(new_hashes) - len(added) - len(changed))
+    if args.dry_run or not (added or changed or removed):
+        return
+
+    update = {'inputs': args.inputs, 'added': len(added), 'changed': len(changed), 'removed': len(removed)}
+    updates = manifest.get('updates', [])
+    shards = manifest['shards']
+    # files of an update that crashed before its manifest was written are overwritten
+    version = len(updates) + 1
+
+    # re-encode the new content, dataset rows keep collection order
+    to_encode = set(added) | set(changed)
+    rows = [row for row, _id in enumerate(dataset[args.id_column]) if _id in to_encode]
+    delta_ids, delta_vectors = [], np.zeros((0, manifest['dim']), dtype=manifest['dtype'])
+    if rows:
+        update_dir = Path('updates', f'{version:03d}')
+        writer = encode_rows(dataset, rows, Path(embedding_dir, update_dir), args)
+        shards.append({
+            'embeddings': str(Path(update_dir, writer.path.name)),
+            'ids': str(Path(update_dir, writer.id_path.name)),
+            'rows': writer.rows,
+        })
+        delta_vectors = np.load(writer.path, mmap_mode='r')
+        with writer.id_path.open('r') as f:
+            delta_ids = [line.rstrip('\n') for line in f]
+
+    # tombstone the old rows of removed and changed ids
+    dead_ids = set(removed) | set(changed)
+    tombstones = [live[_id] for _id in dead_ids]
+    if manifest.get('tombstones'):
+        tombstones.extend(np.load(Path(embedding_dir, manifest['tombstones'])).tolist())
+    np.save(Path(embedding_dir, TOMBSTONES.format(version)), np.unique(np.asarray(tombstones, dtype=np.int64)))
+
+    # record the hashes of the new version, the next update does not need to rehash this one
+    with Path(embedding_dir, HASHES.format(version)).open('w') as f:
+        for _id, _hash in new_hashes.items():
+            f.write(f'{_id}\t{_hash}\n')
+
+    # renaming the new manifest into place commits the update, until then the old
+    # manifest and the files it points at are untouched
+    meta = {k: v for k, v in manifest.items() if k not in ['rows', 'dim', 'dtype', 'shards']}
+    meta.update(inputs=args.inputs, tombstones=TOMBSTONES.format(version), hashes=HASHES.format(version), updates=updates + [update])
+    shards = [dict(shard, dim=manifest['dim'], dtype=manifest['dtype']) for shard in shards]
+    write_manifest(embedding_dir, shards, **meta)
+    for key in ['tombstones', 'hashes']:
+        if manifest.get(key) and manifest[key] != meta[key]:
+            Path(embedding_dir, manifest[key]).unlink(missing_ok=True)
+    logging.info('Patched %s', embedding_dir)
+
+    if args.index:
+        # after the store is committed, a crash here leaves an index to rebuild with index.py
+        patch_index(args.index, dead_ids, delta_vectors, delta_ids)
+    logging.info('Done')
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+from pathlib import Path
+from collections import namedtuple
+from contextlib import contextmanager
+from .utils import get_cache_dir
+
+import logging
+
+# bump whenever the on-disk layout of a cached artifact changes
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+SIZE_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+CacheEntry = namedtuple("CacheEntry", ["key", "path", "size", "last_access", "meta"])
+
+
+def parse_size(size):
+    """parse a human readable size such as `500M` or `20G` into bytes"""
+    if size is None or isinstance(size, int):
+        return size
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1] if size and size[-1] in SIZE_UNITS else ""
+    return int(float(size[: len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def format_size(size):
+    for unit in ["", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+class CacheManager:
+    """Cache of derived artifacts, keyed by the fingerprints they were built from.
+
+    Each entry is a directory under the cache dir holding the artifact files
+    and a `meta.json`. Entries are written into a temporary directory and
+    renamed into place, so readers never see a partial entry. When
+    `max_bytes` is set, the least recently used entries are evicted after
+    every write.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = Path(cache_dir or get_cache_dir())
+        if max_bytes is None:
+            max_bytes = os.environ.get("ATOMIC_CACHE_MAX_BYTES") or None
+        self.max_bytes = parse_size(max_bytes)
+
+    def key(self, name, **fingerprints):
+        payload = json.dumps(
+            {"format_version": FORMAT_VERSION, "name": name, **fingerprints},
+            sort_keys=True,
+        )
+        return f"{name}-{hashlib.sha256(payload.encode()).hexdigest()[:16]}"
+
+    def get(self, key):
+        """return the entry directory for `key`, or None on a miss"""
+        path = Path(self.cache_dir, key)
+        meta_path = Path(path, META_FILE)
+        if not meta_path.exists():
+            return None
+        # the mtime of meta.json is the last access time used for LRU
+        os.utime(meta_path)
+        return path
+
+    @contextmanager
+    def put(self, key, **meta):
+        """yield a temporary directory to write the entry into, then publish it"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=self.cache_dir))
+        try:
+            yield tmp_path
+            meta.update(key=key, format_version=FORMAT_VERSION, created=time.time())
+            with Path(tmp_path, META_FILE).open("w") as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp_path, Path(self.cache_dir, key))
+            except OSError:
+                # another process published the same entry first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=[key])
+
+    def entries(self):
+        """list the published entries, least recently used first"""
+        if not self.cache_dir.exists():
+            return []
+
+        entries = []
+        for path in self.cache_dir.iterdir():
+            meta_path = Path(path, META_FILE)
+            if not meta_path.exists():
+                continue
+            with meta_path.open("r") as f:
+                meta = json.load(f)
+            size = sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+            entries.append(
+                CacheEntry(path.name, path, size, meta_path.stat().st_mtime, meta)
+            )
+        return sorted(entries, key=lambda entry: entry.last_access)
+
+    def remove(self, key):
+        logging.info("Remove cache entry %s", key)
+        shutil.rmtree(Path(self.cache_dir, key), ignore_errors=True)
+
+    def evict(self, max_bytes, keep=(), name=None):
+        """remove least recently used entries, of `name` only if given, until they fit in `max_bytes`"""
+        entries = self.entries()
+        if name is not None:
+            entries = [entry for entry in entries if entry.meta.get("name") == name]
+        total = sum(entry.size for entry in entries)
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            if entry.key in keep:
+                continue
+            self.remove(entry.key)
+            total -= entry.size
+
+    def prune(self, max_bytes=None, older_than=None, name=None):
+        """remove entries by name, by age in seconds and/or down to a size cap
+
+        With `name`, the other filters only see the entries of that name, so
+        `max_bytes` caps the size of those entries alone.
+        """
+        now = time.time()
+        for entry in self.entries():
+            if name is not None and entry.meta.get("name") != name:
+                continue
+            if older_than is not None and now - entry.last_access > older_than:
+                self.remove(entry.key)
+            elif older_than is None and max_bytes is None:
+                self.remove(entry.key)
+        if max_bytes is not None:
+            self.evict(max_bytes, name=name)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser("Manage the AToMiC cache")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list", help="list cache entries, least recently used first")
+
+    prune = commands.add_parser("prune", help="remove cache entries")
+    prune.add_argument("--max_bytes", type=str, default=None, help="e.g. 20G")
+    prune.add_argument("--older_than_days", type=float, default=None)
+    prune.add_argument("--name", type=str, default=None, help="e.g. row-index")
+
+    remove = commands.add_parser("remove", help="remove a single cache entry")
+    remove.add_argument("key", type=str)
+    return parser
+
+
+def main(args):
+    cache = CacheManager(args.cache_dir)
+    if args.command == "list":
+        entries = cache.entries()
+        for entry in entries:
+            last_access = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_access))
+            source = entry.meta.get("data_name_or_path", "")
+            print(f"{entry.key}\t{format_size(entry.size)}\t{last_access}\t{source}")
+        print(f"total\t{format_size(sum(entry.size for entry in entries))}")
+    elif args.command == "prune":
+        older_than = args.older_than_days
+        if older_than is not None:
+            older_than = older_than * 24 * 3600
+        cache.prune(
+            max_bytes=parse_size(args.max_bytes), older_than=older_than, name=args.name
+        )
+    elif args.command == "remove":
+        cache.remove(args.key)
+
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,9 +1,14 @@
-import json
-from collections import defaultdict
-from datasets import Dataset, load_dataset
-from tqdm.auto import tqdm
+import os
+from bisect import bisect_left
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from datasets import Dataset, Features, IterableDataset, load_dataset
+from glob import glob
 from pathlib import Path
-from .utils import _log_time_usage, get_cache_dir
+from .cache import CacheManager
+from .utils import _log_time_usage
 
 import logging
 
@@ -12,6 +17,104 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# qrels splits in priority order; rows judged in none of them go to "other"
+SPLITS = ("train", "validation", "test", "other")
+
+
+class _SortedIds:
+    """Sequence view over a sorted Arrow string array, usable with `bisect`."""
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self.ids[index].as_py()
+
+
+class IdIndex:
+    """id -> row index stored as an Arrow IPC file of sorted ids.
+
+    The file is opened with mmap, so nothing but the pages touched by the
+    binary search are read into memory. Lookups are O(log n). `get_many`
+    trades memory for speed and keeps a copy of the ids.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        table = pa.ipc.open_file(pa.memory_map(str(self.path), "r")).read_all()
+        self.ids = _SortedIds(_single_chunk(table.column("id")))
+        self.rows = _single_chunk(table.column("row")).to_numpy()
+        # NumPy copy of the ids for batch lookups, made on first use
+        self._sorted_ids = None
+
+    @classmethod
+    def build(cls, ids, path):
+        """Sort the id column in a single vectorized pass and write it to `path`."""
+        path = Path(path)
+        ids = ids.cast(pa.large_string())
+        order = pc.sort_indices(ids)
+        table = pa.table(
+            {"id": ids.take(order), "row": order.cast(pa.int64())}
+        ).combine_chunks()
+
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with pa.OSFile(str(tmp_path), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def get(self, example_id, default=None):
+        pos = bisect_left(self.ids, example_id)
+        if pos < len(self.ids) and self.ids[pos] == example_id:
+            return int(self.rows[pos])
+        return default
+
+    def __getitem__(self, example_id):
+        row_index = self.get(example_id)
+        if row_index is None:
+            raise KeyError(example_id)
+        return row_index
+
+    def get_many(self, example_ids):
+        """Rows of `example_ids` with one vectorized `np.searchsorted`.
+
+        The first call copies the sorted id column into a fixed-width bytes
+        array, which sorts like Arrow (by UTF-8 bytes) and is compared with
+        memcmp, so every later batch is binary searched in C. Raises
+        `KeyError` with the first missing id.
+        """
+        if self._sorted_ids is None:
+            ids = pc.cast(self.ids.ids, pa.large_binary())
+            self._sorted_ids = ids.to_numpy(zero_copy_only=False).astype(np.bytes_)
+        keys = np.array([example_id.encode("utf-8") for example_id in example_ids], dtype=np.bytes_)
+        if not len(keys):
+            return np.zeros(0, dtype=np.int64)
+        if not len(self._sorted_ids):
+            raise KeyError(example_ids[0])
+
+        pos = np.searchsorted(self._sorted_ids, keys)
+        pos = np.minimum(pos, len(self._sorted_ids) - 1)
+        missing = np.flatnonzero(self._sorted_ids[pos] != keys)
+        if len(missing):
+            raise KeyError(example_ids[missing[0]])
+        return self.rows[pos].astype(np.int64)
+
+    def __contains__(self, example_id):
+        return self.get(example_id) is not None
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def _single_chunk(column):
+    if column.num_chunks == 1:
+        return column.chunk(0)
+    return column.combine_chunks()
+
 
 class AtomicDataset(Dataset):
     def __init__(
@@ -23,77 +126,195 @@ class AtomicDataset(Dataset):
     ):
         with _log_time_usage("load_dataset: "):
             dataset = load_dataset(data_name_or_path, split="train")
-            super().__init__(dataset._data)
+            super().__init__(dataset._data, fingerprint=dataset._fingerprint)
 
-        if cache_file_path:
-            self.cache_file_path = cache_file_path
-        else:
-            self.cache_file_path = Path(get_cache_dir(), f"{id_column}.row-index.json")
-
-        if not self.cache_file_path.parent.exists():
-            self.cache_file_path.parent.mkdir(parents=True)
+        self.data_name_or_path = data_name_or_path
+        self.id_column = id_column
+        self.cache = CacheManager()
+        self.cache_file_path = Path(cache_file_path) if cache_file_path else None
 
-        with _log_time_usage("build_dict: "):
-            self.id_index_dict = self._get_info_dict(id_column)
+        with _log_time_usage("build_index: "):
+            self.id_index = self._get_id_index(id_column)
 
-        self.split_dict = None
+        self.split_index = None
         if qrel_name_or_path:
-            self.cache_split_path = Path(get_cache_dir(), f"{id_column}.split.json")
             qrels = load_dataset(qrel_name_or_path)
-            self.split_dict = self._get_split_dict(qrels, id_column)
+            with _log_time_usage("build_split: "):
+                self.split_index = self._get_split_index(qrels, id_column)
 
-    def _get_info_dict(self, id_column):
+    def _get_cached(self, name, build, **fingerprints):
+        """return the cache entry for this dataset, building it on a miss"""
+        key = self.cache.key(
+            name, dataset=self._fingerprint, id_column=self.id_column, **fingerprints
+        )
+        path = self.cache.get(key)
+        if path is None:
+            meta = dict(
+                name=name,
+                data_name_or_path=str(self.data_name_or_path),
+                id_column=self.id_column,
+            )
+            with self.cache.put(key, **meta) as tmp_path:
+                build(tmp_path)
+            path = self.cache.get(key)
+        return path
 
-        if self.cache_file_path.exists():
-            with open(self.cache_file_path, "r") as f:
-                return json.load(f)
-        else:
-            id_index_dict = {
-                row: index
-                for index, row in tqdm(
-                    enumerate(self[id_column]),
-                    total=len(self),
-                    desc="build id2row dict",
-                )
-            }
-            with open(self.cache_file_path, "w") as f:
-                json.dump(id_index_dict, f)
-            return id_index_dict
-
-    def _get_split_dict(self, qrels, id_column):
-        if self.cache_split_path.exists():
-            with open(self.cache_split_path, "r") as f:
-                return json.load(f)
-        else:
-            train = set(qrels["train"][id_column])
-            validation = set(qrels["validation"][id_column])
-            test = set(qrels["test"][id_column])
-            split_dict = defaultdict(list)
-            for index, row in tqdm(
-                enumerate(self[id_column]), total=len(self), desc="build split dict"
-            ):
-                if row in train:
-                    split_dict["train"].append(index)
-                elif row in validation:
-                    split_dict["validation"].append(index)
-                elif row in test:
-                    split_dict["test"].append(index)
+    def _get_id_index(self, id_column):
+        ids = self.data.column(id_column)
+        if self.cache_file_path:
+            if self.cache_file_path.exists():
+                return IdIndex(self.cache_file_path)
+            self.cache_file_path.parent.mkdir(parents=True, exist_ok=True)
+            return IdIndex.build(ids, self.cache_file_path)
+
+        path = self._get_cached(
+            "row-index", lambda tmp_path: IdIndex.build(ids, Path(tmp_path, "index.arrow"))
+        )
+        return IdIndex(Path(path, "index.arrow"))
+
+    def _get_split_index(self, qrels, id_column):
+        def build(tmp_path):
+            ids = self.data.column(id_column)
+            index_dtype = np.int32 if len(ids) < 2**31 else np.int64
+            assigned = np.zeros(len(ids), dtype=bool)
+            for split in SPLITS:
+                if split == "other":
+                    mask = ~assigned
                 else:
-                    split_dict["other"].append(index)
+                    value_set = pc.unique(qrels[split].data.column(id_column))
+                    mask = pc.is_in(ids, value_set=value_set).to_numpy()
+                    mask &= ~assigned
+                    assigned |= mask
+                np.save(
+                    Path(tmp_path, f"{split}.npy"),
+                    np.flatnonzero(mask).astype(index_dtype),
+                )
 
-            with open(self.cache_split_path, "w") as f:
-                json.dump(split_dict, f)
-            return split_dict
+        qrels_fingerprint = {split: qrels[split]._fingerprint for split in sorted(qrels)}
+        path = self._get_cached("split", build, qrels=qrels_fingerprint)
+        return {
+            split: np.load(Path(path, f"{split}.npy"), mmap_mode="r")
+            for split in SPLITS
+        }
 
     def get_data_by_id(self, example_id):
-        row_index = self.id_index_dict[example_id]
+        row_index = self.id_index[example_id]
         return self[row_index]
 
+    def get_many(self, example_ids, columns=None, decode=False):
+        """Fetch the rows of `example_ids` with a single sorted Arrow `take`.
+
+        Only `columns` (default: all) are read. Image bytes are left encoded
+        unless `decode` is set. Returns a dict of column -> list, in the order
+        of `example_ids`.
+        """
+        columns = columns or self.column_names
+        rows = self.id_index.get_many(example_ids)
+        order = np.argsort(rows, kind="stable")
+
+        table = self.data.table.select(columns).take(pa.array(rows[order]))
+        table = table.take(pa.array(np.argsort(order)))
+        batch = table.to_pydict()
+
+        if decode:
+            features = Features({column: self.features[column] for column in columns})
+            batch = features.decode_batch(batch)
+        return batch
+
     def get_split(self, split):
-        if not self.split_dict:
-            raise ValueError
+        if not self.split_index:
+            raise ValueError("qrel_name_or_path is required to select a split")
         else:
-            return self.select(self.split_dict[split])
+            return self.select(self.split_index[split])
+
+
+def load_streaming_dataset(
+    data_files,
+    id_column="image_id",
+    qrel_name_or_path=None,
+    split=None,
+    columns=None,
+    batch_size=1024,
+):
+    """Stream a collection from local Parquet shards without materializing it.
+
+    `data_files` is a directory or a glob of `.parquet` files. Only `columns`
+    are read from the files, and when `split` is given only the rows that
+    `AtomicDataset.get_split` would return are kept. Each file is one shard of
+    the returned `IterableDataset`, so DataLoader workers and
+    `datasets.distributed.split_dataset_by_node` divide the files between them
+    deterministically.
+    """
+    files = _list_parquet_files(data_files)
+    features = Features.from_arrow_schema(pq.read_schema(files[0]))
+    if columns:
+        features = Features({column: features[column] for column in columns})
+
+    include, exclude = None, None
+    if split:
+        if not qrel_name_or_path:
+            raise ValueError("qrel_name_or_path is required to select a split")
+        qrels = load_dataset(qrel_name_or_path)
+        include, exclude = _get_split_value_sets(qrels, split, id_column)
+
+    return IterableDataset.from_generator(
+        _iter_parquet_rows,
+        features=features,
+        gen_kwargs=dict(
+            files=files,
+            columns=tuple(features),
+            id_column=id_column,
+            include=include,
+            exclude=exclude,
+            batch_size=batch_size,
+        ),
+    )
+
+
+def _list_parquet_files(data_files):
+    if Path(data_files).is_dir():
+        files = sorted(str(f) for f in Path(data_files).rglob("*.parquet"))
+    else:
+        files = sorted(glob(str(data_files)))
+    if not files:
+        raise FileNotFoundError(f"No parquet files found in {data_files}")
+    return files
+
+
+def _get_split_value_sets(qrels, split, id_column):
+    """ids a row must be in (`include`) and must not be in (`exclude`) to be in `split`"""
+    include, exclude = None, []
+    for name in SPLITS:
+        if name == split:
+            break
+        exclude.append(qrels[name].data.column(id_column))
+    else:
+        raise ValueError(f"Unknown split: {split}")
+
+    if split != "other":
+        include = pc.unique(qrels[split].data.column(id_column))
+    if exclude:
+        exclude = pc.unique(pa.chunked_array([c for e in exclude for c in e.chunks]))
+    else:
+        exclude = None
+    return include, exclude
+
+
+def _iter_parquet_rows(files, columns, id_column, include, exclude, batch_size):
+    read_columns = list(columns)
+    if id_column not in read_columns:
+        read_columns.append(id_column)
+
+    for f in files:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size, columns=read_columns):
+            table = pa.Table.from_batches([batch])
+            ids = table.column(id_column)
+            if include is not None:
+                table = table.filter(pc.is_in(ids, value_set=include))
+                ids = table.column(id_column)
+            if exclude is not None:
+                table = table.filter(pc.invert(pc.is_in(ids, value_set=exclude)))
+            yield from table.select(list(columns)).to_pylist()
 
 
 if __name__ == "__main__":
@@ -22,5 +22,5 @@ def _log_time_usage(prefix=""):
 def get_cache_dir():
     custom_dir = os.environ.get("ATOMIC_CACHE")
     if custom_dir is not None and custom_dir != "":
-        return custom_dir
+        return Path(custom_dir)
     return Path(Path.home(), ".cache", "atomic")
\ No newline at end of file